@@ -3,44 +3,69 @@ VERSION = "1.10"
 import sys
 import subprocess
 import importlib
+import importlib.util
 import os
 
+# modules of requirements.txt, convert.py imports them in its own process
+REQUIRED_MODULES = ["torch", "tqdm", "safetensors", "gguf", "sentencepiece", "yaml", "numpy"]
+
 def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
 
-try:
-    import torch, tqdm, safetensors, gguf, sentencepiece, yaml, numpy
-except ImportError:
+def missing_modules():
+    # find_spec only locates the packages, importing torch just to check for it takes seconds
+    return [name for name in REQUIRED_MODULES if importlib.util.find_spec(name) is None]
+
+if missing_modules():
     print("Some required packages are missing. Installing from requirements.txt...")
     install("requirements.txt")
-    import torch, tqdm, safetensors, gguf, sentencepiece, yaml, numpy
+    importlib.invalidate_caches()
+    if missing_modules():
+        sys.exit(f"Still missing after installing requirements.txt: {', '.join(missing_modules())}")
 
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
 import os
-import shutil
-import winsound
+import queue
+import threading
 import tkinter.scrolledtext as scrolledtext
+from conversion_cache import ConversionCache
+from model_index import ModelIndex, detect_arch, model_name
+import pipeline
+
+LOG_POLL_INTERVAL_MS = 100
+MAX_LOG_LINES = 5000
 
 def scroll_entry_to_end(entry):
     entry.xview_moveto(1)
 
 def browse_file(entry):
-    file_path = filedialog.askopenfilename(filetypes=[("Model files", "*.safetensors *.sft")])
+    file_path = filedialog.askopenfilename(filetypes=[("Model files", "*.safetensors *.sft *.ckpt *.pt *.pth *.bin *.index.json")])
     if file_path:
         file_path = file_path.replace('\\', '/')  # Ensure forward slashes
         entry.delete(0, tk.END)
         entry.insert(0, file_path)
         scroll_entry_to_end(entry)
         suggest_output_file()  # Call this instead of update_output_file
+        show_model_info(file_path)
+
+def show_model_info(file_path):
+    # header only, so this is instant even for multi-GB models
+    try:
+        index = ModelIndex.from_file(file_path)
+        model_arch = detect_arch(index)
+        model_info_var.set(f"Detected: {model_arch.arch}, {len(index)} tensors, {index.n_params / 1e9:.2f}B parameters")
+    except ValueError:
+        model_info_var.set("Model details will be shown once the conversion starts.")
+    except (OSError, AssertionError) as e:
+        model_info_var.set(f"Unsupported model: {e}")
 
 def suggest_output_file():
     input_file = input_entry.get()
     quantize_level = quantize_level_var.get()
     if input_file:
         input_dir = os.path.dirname(input_file)
-        input_filename = os.path.basename(input_file)
-        input_name, _ = os.path.splitext(input_filename)
+        input_name = model_name(input_file)
         output_file = f"{input_dir}/{input_name}-{quantize_level}.gguf"
         output_entry.delete(0, tk.END)
         output_entry.insert(0, output_file)
@@ -54,8 +79,7 @@ def browse_output_file(entry):
     # Generate a default output filename
     if input_file:
         input_dir = os.path.dirname(input_file)
-        input_filename = os.path.basename(input_file)
-        input_name, _ = os.path.splitext(input_filename)
+        input_name = model_name(input_file)
         default_filename = f"{input_name}-{quantize_level}.gguf"
     else:
         default_filename = f"output-{quantize_level}.gguf"
@@ -75,149 +99,206 @@ def browse_output_file(entry):
         entry.insert(0, file_path)
         scroll_entry_to_end(entry)
 
+def update_direct_checkbox():
+    if batch_var.get() or quantize_level_var.get() in pipeline.DIRECT_LEVELS:
+        direct_checkbox.config(state='normal')
+    else:
+        direct_checkbox.config(state='disabled')
+
+def toggle_batch_mode():
+    if batch_var.get():
+        batch_frame.pack(pady=(0, 10), padx=10, before=input_frame)
+    else:
+        batch_frame.pack_forget()
+    update_direct_checkbox()
+
 def disable_ui():
-    global input_entry, output_entry, input_browse, output_browse, quantize_dropdown, run_button
+    global input_entry, output_entry, input_browse, output_browse, quantize_dropdown, run_button, direct_checkbox, cache_checkbox
+    batch_checkbox.config(state='disabled')
+    for checkbox in batch_level_checkboxes:
+        checkbox.config(state='disabled')
     input_entry.config(state='disabled')
     output_entry.config(state='disabled')
     input_browse.config(state='disabled')
     output_browse.config(state='disabled')
     quantize_dropdown.config(state='disabled')
+    direct_checkbox.config(state='disabled')
+    cache_checkbox.config(state='disabled')
+    clear_cache_button.config(state='disabled')
     run_button.config(state='disabled')
+    cancel_button.config(state='normal')
 
 def enable_ui():
-    global input_entry, output_entry, input_browse, output_browse, quantize_dropdown, run_button
+    global input_entry, output_entry, input_browse, output_browse, quantize_dropdown, run_button, direct_checkbox, cache_checkbox
     input_entry.config(state='normal')
     output_entry.config(state='normal')
     input_browse.config(state='normal')
     output_browse.config(state='normal')
     quantize_dropdown.config(state='readonly')
+    update_direct_checkbox()
+    cache_checkbox.config(state='normal')
+    clear_cache_button.config(state='normal')
+    batch_checkbox.config(state='normal')
+    for checkbox in batch_level_checkboxes:
+        checkbox.config(state='normal')
     run_button.config(state='normal')
+    cancel_button.config(state='disabled')
 
 def run_llama_quantize():
     input_file = input_entry.get()
     output_file = output_entry.get()
     quantize_level = quantize_level_var.get()
-    
-    if not input_file or not output_file:
-        messagebox.showerror("Error", "Please select both input and output files.")
-        return
-    
-    output_dir = os.path.dirname(output_file)
-    required_space = 40_000_000_000  # ~40 GB (a bit more than 36.5 GB)
-    available_space = shutil.disk_usage(output_dir).free
-
-    if available_space < required_space:
-        required_gb = required_space / (1024**3)
-        available_gb = available_space / (1024**3)
-        messagebox.showerror("Error", f"You need {required_gb:.1f} GB of drive space to continue. Only {available_gb:.1f} GB available.")
-        return
+    direct = direct_quantize_var.get()
+
+    if batch_var.get():
+        levels = [level for level, var in batch_level_vars.items() if var.get()]
+        if not input_file:
+            messagebox.showerror("Error", "Please select an input file.")
+            return
+        if not levels:
+            messagebox.showerror("Error", "Please select at least one quantize level.")
+            return
+        # batch outputs are named after the input, in the directory of the output file
+        output_dir = os.path.dirname(output_file) or os.path.dirname(input_file)
+        job = pipeline.Job.from_levels(input_file, levels, output_dir, direct=direct)
+    else:
+        if not input_file or not output_file:
+            messagebox.showerror("Error", "Please select both input and output files.")
+            return
+        job = pipeline.Job(input_file, {quantize_level: output_file}, direct=direct)
+
+    cache = ConversionCache() if use_cache_var.get() else None
 
     disable_ui()
-    
-    # Clear previous log
+    cancel_button.config(state='disabled') # nothing to cancel until the run starts
     process_text.delete('1.0', tk.END)
-    process_text.insert(tk.END, "Starting conversion process...\n")
-    process_text.see(tk.END)
-    root.update()
+    append_log("Checking the model...\n")
 
-    # Convert the input file to GGUF format
-    convert_py_path = resource_path("convert.py")
-    output_dir = os.path.dirname(output_file)
-    temp_gguf_file = os.path.join(output_dir, "temporary_file_during_quantization")
+    # preflight reads the model's header (and loads a legacy .ckpt whole), so it
+    # runs on a worker thread and finish_preflight() picks up the result
+    checked = []
 
-    # Add cleanup of existing temp file
-    if os.path.exists(temp_gguf_file):
+    def check():
         try:
-            os.remove(temp_gguf_file)
-            process_text.insert(tk.END, "Cleaned up existing temporary file.\n")
-            process_text.see(tk.END)
-            root.update()
+            estimate = pipeline.preflight(job, cache=cache)
+            checked.append((estimate, pipeline.check_disk_space([estimate]), pipeline.available_memory()))
         except Exception as e:
-            process_text.insert(tk.END, f"Error cleaning up temporary file: {e}\n")
-            process_text.see(tk.END)
-            root.update()
-            enable_ui()
-            return
+            checked.append(e)
 
-    try:
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        startupinfo.wShowWindow = subprocess.SW_HIDE
-
-        # Get the Python executable path from the current environment
-        pythonpath = sys.executable
-        
-        process = subprocess.Popen([pythonpath, convert_py_path, "--src", input_file, "--dst", temp_gguf_file], 
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, 
-                                   bufsize=1, universal_newlines=True, startupinfo=startupinfo)
-        
-        for line in process.stdout:
-            process_text.insert(tk.END, line)
-            process_text.see(tk.END)
-            root.update()
-        
-        process.wait()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, process.args)
-        
-        process_text.insert(tk.END, "Conversion completed successfully.\n")
-    except subprocess.CalledProcessError as e:
-        process_text.insert(tk.END, f"Error converting file: {e}\n")
-        process_text.insert(tk.END, f"Command: {e.cmd}\n")
-        process_text.insert(tk.END, f"Return code: {e.returncode}\n")
-        process_text.see(tk.END)
-        root.update()
+    thread = threading.Thread(target=check, daemon=True)
+    thread.start()
+    root.after(LOG_POLL_INTERVAL_MS, finish_preflight, thread, job, cache, checked)
+
+def finish_preflight(thread, job, cache, checked):
+    if thread.is_alive():
+        root.after(LOG_POLL_INTERVAL_MS, finish_preflight, thread, job, cache, checked)
+        return
+    if isinstance(checked[0], Exception):
+        append_log(f"Error: {checked[0]}\n")
+        messagebox.showerror("Error", str(checked[0]))
         enable_ui()
         return
 
-    # Quantize the converted file
-    llama_quantize_path = resource_path("llama-quantize.exe")
-    process_text.insert(tk.END, "Starting quantization process...\n")
-    process_text.see(tk.END)
-    root.update()
+    estimate, short, memory = checked[0]
+    if short:
+        directory, needed, free = short[0]
+        messagebox.showerror("Error", f"You need {needed / 1024**3:.1f} GB of drive space in {directory} to continue. Only {free / 1024**3:.1f} GB available.")
+        enable_ui()
+        return
 
-    try:
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        startupinfo.wShowWindow = subprocess.SW_HIDE
-
-        process = subprocess.Popen([llama_quantize_path, temp_gguf_file, output_file, quantize_level], 
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, 
-                                   bufsize=1, universal_newlines=True, startupinfo=startupinfo)
-        
-        for line in process.stdout:
-            process_text.insert(tk.END, line)
-            process_text.see(tk.END)
-            root.update()
-        
-        process.wait()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, process.args)
-        
-        process_text.insert(tk.END, "Quantization completed successfully.\n")
-    except subprocess.CalledProcessError as e:
-        process_text.insert(tk.END, f"Error running llama-quantize: {e}\n")
-        process_text.insert(tk.END, f"Command: {e.cmd}\n")
-        process_text.insert(tk.END, f"Return code: {e.returncode}\n")
-        process_text.see(tk.END)
-        root.update()
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_gguf_file):
-            os.remove(temp_gguf_file)
-        
-    process_text.insert(tk.END, "Quantization process completed.")
+    if memory is not None and estimate.peak_memory > memory:
+        if not messagebox.askyesno("Low memory", f"This may need up to {estimate.peak_memory / 1024**3:.1f} GB of RAM, "
+                                   f"only {memory / 1024**3:.1f} GB is available. Continue anyway?"):
+            enable_ui()
+            return
+
+    start_run(job, cache, estimate)
+
+def start_run(job, cache, estimate):
+    global cancel_event
+    cancel_button.config(state='normal')
+
+    if len(job.outputs) > 1:
+        append_log(f"Starting batch of {len(job.outputs)} quantizations: {', '.join(job.outputs)}\n")
+    append_log(estimate.describe())
+
+    # the pipeline runs on a worker thread and only queues its log lines,
+    # drain_log() moves them into the widget in batches from the Tk event loop
+    cancel_event = threading.Event()
+    log_queue = queue.Queue()
+    results = []
+
+    def worker():
+        try:
+            results.extend(pipeline.run_job(job, log_queue.put, cache=cache, cancel=cancel_event))
+        except pipeline.Cancelled:
+            log_queue.put("Cancelled. Run again with the same settings to resume an unfinished conversion.\n")
+        except Exception as e:
+            log_queue.put(f"Error: {e}\n")
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    root.after(LOG_POLL_INTERVAL_MS, drain_log, thread, log_queue, results)
+
+def append_log(text):
+    process_text.insert(tk.END, text)
+    # cap the scrollback, re-rendering a huge log is what makes the widget slow
+    line_count = int(process_text.index('end-1c').split('.')[0])
+    if line_count > MAX_LOG_LINES:
+        process_text.delete('1.0', f"{line_count - MAX_LOG_LINES + 1}.0")
     process_text.see(tk.END)
-    root.update()
-    
+
+def drain_log(thread, log_queue, results):
+    lines = []
+    while True:
+        try:
+            lines.append(log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if lines:
+        append_log("".join(lines))
+
+    if thread.is_alive() or not log_queue.empty():
+        root.after(LOG_POLL_INTERVAL_MS, drain_log, thread, log_queue, results)
+        return
+
+    if len(results) > 1:
+        append_log("\n" + pipeline.format_summary(results))
+    append_log("Quantization process completed.")
+
     enable_ui()
-    
-    # Play sound effect
-    winsound.PlaySound("SystemAsterisk", winsound.SND_ALIAS)
+    notify_finished()
+
+def notify_finished():
+    if os.name == "nt":
+        import winsound
+        winsound.PlaySound("SystemAsterisk", winsound.SND_ALIAS)
+    else:
+        root.bell()
+
+def clear_cache():
+    cache = ConversionCache()
+    size = cache.size()
+    if not size:
+        messagebox.showinfo("Cache", f"The cache in {cache.cache_dir} is empty.")
+        return
+    if messagebox.askyesno("Clear cache", f"Delete {size / 1024**3:.1f} GB of converted files in {cache.cache_dir}? "
+                           f"The cache is limited to {cache.quota / 1024**3:.0f} GB (EASYQUANT_CACHE_QUOTA_GB)."):
+        freed = cache.clear()
+        append_log(f"Cleared {freed / 1024**3:.1f} GB from the conversion cache.\n")
+
+def cancel_run():
+    cancel_button.config(state='disabled')
+    append_log("Cancelling...\n")
+    cancel_event.set()
 
 def main():
     global root, process_text, input_entry, output_entry, quantize_dropdown, run_button, quantize_level_var
     global input_browse, output_browse  # Add these two variables
+    global direct_quantize_var, direct_checkbox, use_cache_var, cache_checkbox
+    global cancel_button, clear_cache_button
+    global batch_var, batch_checkbox, batch_frame, batch_level_vars, batch_level_checkboxes, input_frame
+    global model_info_var
     root = tk.Tk()
     root.title(f"Easy Quantization GUI v{VERSION}")
     root.geometry("800x600")
@@ -229,13 +310,36 @@ def main():
     quantize_label = tk.Label(quantize_frame, text="Quantize Level:")
     quantize_label.pack(side=tk.LEFT)
 
-    quantize_levels = ["Q2_K", "Q3_K_S", "Q4_0", "Q4_1", "Q4_K_S", "Q5_0", "Q5_1", "Q5_K_S", "Q6_K", "Q8_0", "F16"]
+    quantize_levels = pipeline.QUANTIZE_LEVELS
     quantize_level_var = tk.StringVar(root)
     quantize_level_var.set("Q8_0")  # Set default value to Q8_0
 
     quantize_dropdown = ttk.Combobox(quantize_frame, textvariable=quantize_level_var, values=quantize_levels, state="readonly")
     quantize_dropdown.pack(side=tk.LEFT)
-    quantize_dropdown.bind("<<ComboboxSelected>>", lambda event: suggest_output_file())
+    quantize_dropdown.bind("<<ComboboxSelected>>", lambda event: (suggest_output_file(), update_direct_checkbox()))
+
+    direct_quantize_var = tk.BooleanVar(root, value=False)
+    direct_checkbox = tk.Checkbutton(quantize_frame, text="Direct where possible (no temporary F16 file)", variable=direct_quantize_var)
+    direct_checkbox.pack(side=tk.LEFT, padx=(10, 0))
+
+    # off by default, the cache keeps F16 files (up to its quota) on the system drive
+    use_cache_var = tk.BooleanVar(root, value=False)
+    cache_checkbox = tk.Checkbutton(quantize_frame, text="Cache converted F16 file", variable=use_cache_var)
+    cache_checkbox.pack(side=tk.LEFT, padx=(10, 0))
+
+    batch_var = tk.BooleanVar(root, value=False)
+    batch_checkbox = tk.Checkbutton(quantize_frame, text="Batch", variable=batch_var, command=toggle_batch_mode)
+    batch_checkbox.pack(side=tk.LEFT, padx=(10, 0))
+
+    # Levels to produce in batch mode, only shown while batch mode is enabled
+    batch_frame = tk.Frame(root)
+    batch_level_vars = {}
+    batch_level_checkboxes = []
+    for i, level in enumerate(quantize_levels):
+        batch_level_vars[level] = tk.BooleanVar(root, value=False)
+        checkbox = tk.Checkbutton(batch_frame, text=level, variable=batch_level_vars[level])
+        checkbox.grid(row=i // 6, column=i % 6, sticky='w')
+        batch_level_checkboxes.append(checkbox)
 
     # Input file selection
     input_frame = tk.Frame(root)
@@ -253,6 +357,11 @@ def main():
     # Add binding to scroll input entry when it gains focus
     input_entry.bind("<FocusIn>", lambda event: scroll_entry_to_end(input_entry))
 
+    # Architecture and size of the selected model
+    model_info_var = tk.StringVar()
+    model_info_label = tk.Label(root, textvariable=model_info_var, anchor='w')
+    model_info_label.pack(padx=10, fill=tk.X)
+
     # Output file selection
     output_frame = tk.Frame(root)
     output_frame.pack(pady=10, padx=10, fill=tk.X)
@@ -269,9 +378,18 @@ def main():
     # Add binding to scroll output entry when it gains focus
     output_entry.bind("<FocusIn>", lambda event: scroll_entry_to_end(output_entry))
 
-    # Run button
-    run_button = tk.Button(root, text="Run Quantization", command=run_llama_quantize)
-    run_button.pack(pady=20)
+    # Run and cancel buttons
+    button_frame = tk.Frame(root)
+    button_frame.pack(pady=20)
+
+    run_button = tk.Button(button_frame, text="Run Quantization", command=run_llama_quantize)
+    run_button.pack(side=tk.LEFT)
+
+    cancel_button = tk.Button(button_frame, text="Cancel", command=cancel_run, state='disabled')
+    cancel_button.pack(side=tk.LEFT, padx=(10, 0))
+
+    clear_cache_button = tk.Button(button_frame, text="Clear Cache", command=clear_cache)
+    clear_cache_button.pack(side=tk.LEFT, padx=(10, 0))
 
     # Add process log to bottom of main window
     process_frame = tk.Frame(root)
@@ -285,15 +403,5 @@ def main():
 
     root.mainloop()
 
-def resource_path(relative_path):
-    """ Get absolute path to resource, works for dev and for PyInstaller """
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-
-    return os.path.join(base_path, relative_path)
-
 if __name__ == "__main__":
     main()
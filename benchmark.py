@@ -0,0 +1,564 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import contextlib
+import tracemalloc
+
+import torch
+import gguf
+from safetensors.torch import save_file
+
+import convert
+from quant_error import TensorError
+
+def flux_shapes(scale=1.0, depth=(19, 38)):
+    """Key layout and shapes of a Flux (reference format) model"""
+    head_dim = 128
+    hidden = max(1, round(24 * scale)) * head_dim
+    mlp = hidden * 4
+    double_blocks, single_blocks = (max(1, round(n * scale)) for n in depth)
+
+    shapes = {
+        "img_in.weight": (hidden, 64),
+        "img_in.bias": (hidden,),
+        "txt_in.weight": (hidden, 4096),
+        "txt_in.bias": (hidden,),
+        "final_layer.linear.weight": (64, hidden),
+        "final_layer.linear.bias": (64,),
+        "final_layer.adaLN_modulation.1.weight": (hidden * 2, hidden),
+        "final_layer.adaLN_modulation.1.bias": (hidden * 2,),
+    }
+    for embedder, in_dim in [("time_in", 256), ("vector_in", 768), ("guidance_in", 256)]:
+        shapes[f"{embedder}.in_layer.weight"] = (hidden, in_dim)
+        shapes[f"{embedder}.in_layer.bias"] = (hidden,)
+        shapes[f"{embedder}.out_layer.weight"] = (hidden, hidden)
+        shapes[f"{embedder}.out_layer.bias"] = (hidden,)
+    for i in range(double_blocks):
+        for stream in ["img", "txt"]:
+            pfx = f"double_blocks.{i}.{stream}"
+            shapes[f"{pfx}_mod.lin.weight"] = (hidden * 6, hidden)
+            shapes[f"{pfx}_mod.lin.bias"] = (hidden * 6,)
+            shapes[f"{pfx}_attn.qkv.weight"] = (hidden * 3, hidden)
+            shapes[f"{pfx}_attn.qkv.bias"] = (hidden * 3,)
+            shapes[f"{pfx}_attn.norm.query_norm.scale"] = (head_dim,)
+            shapes[f"{pfx}_attn.norm.key_norm.scale"] = (head_dim,)
+            shapes[f"{pfx}_attn.proj.weight"] = (hidden, hidden)
+            shapes[f"{pfx}_attn.proj.bias"] = (hidden,)
+            shapes[f"{pfx}_mlp.0.weight"] = (mlp, hidden)
+            shapes[f"{pfx}_mlp.0.bias"] = (mlp,)
+            shapes[f"{pfx}_mlp.2.weight"] = (hidden, mlp)
+            shapes[f"{pfx}_mlp.2.bias"] = (hidden,)
+    for i in range(single_blocks):
+        pfx = f"single_blocks.{i}"
+        shapes[f"{pfx}.linear1.weight"] = (hidden * 3 + mlp, hidden)
+        shapes[f"{pfx}.linear1.bias"] = (hidden * 3 + mlp,)
+        shapes[f"{pfx}.linear2.weight"] = (hidden, hidden + mlp)
+        shapes[f"{pfx}.linear2.bias"] = (hidden,)
+        shapes[f"{pfx}.norm.query_norm.scale"] = (head_dim,)
+        shapes[f"{pfx}.norm.key_norm.scale"] = (head_dim,)
+        shapes[f"{pfx}.modulation.lin.weight"] = (hidden * 3, hidden)
+        shapes[f"{pfx}.modulation.lin.bias"] = (hidden * 3,)
+    return shapes
+
+def linear(shapes, name, out_dim, in_dim, bias=True):
+    shapes[f"{name}.weight"] = (out_dim, in_dim)
+    if bias:
+        shapes[f"{name}.bias"] = (out_dim,)
+
+def sd3_shapes(scale=1.0, depth=24):
+    """Key layout and shapes of an SD3 (MMDiT reference format) model"""
+    depth = max(1, round(depth * scale))
+    hidden = 64 * max(1, round(24 * scale))
+    shapes = {
+        "x_embedder.proj.weight": (hidden, 16, 2, 2),
+        "x_embedder.proj.bias": (hidden,),
+        "pos_embed": (1, 192 * 192, hidden),
+    }
+    linear(shapes, "t_embedder.mlp.0", hidden, 256)
+    linear(shapes, "t_embedder.mlp.2", hidden, hidden)
+    linear(shapes, "y_embedder.mlp.0", hidden, 2048)
+    linear(shapes, "y_embedder.mlp.2", hidden, hidden)
+    linear(shapes, "context_embedder", hidden, 4096)
+    for i in range(depth):
+        for stream in ["x_block", "context_block"]:
+            pfx = f"joint_blocks.{i}.{stream}"
+            linear(shapes, f"{pfx}.adaLN_modulation.1", hidden * 6, hidden)
+            linear(shapes, f"{pfx}.attn.qkv", hidden * 3, hidden)
+            linear(shapes, f"{pfx}.attn.proj", hidden, hidden)
+            linear(shapes, f"{pfx}.mlp.fc1", hidden * 4, hidden)
+            linear(shapes, f"{pfx}.mlp.fc2", hidden, hidden * 4)
+    linear(shapes, "final_layer.adaLN_modulation.1", hidden * 2, hidden)
+    linear(shapes, "final_layer.linear", 64, hidden)
+    return shapes
+
+def aura_shapes(scale=1.0, depth=(4, 32)):
+    """Key layout and shapes of an AuraFlow model"""
+    hidden = 256 * max(1, round(12 * scale))
+    mlp = hidden * 8 // 3
+    double_layers = max(4, round(depth[0] * scale)) # detection looks for double_layers.3
+    single_layers = max(1, round(depth[1] * scale))
+    shapes = {
+        "positional_encoding": (1, 1024, hidden),
+        "register_tokens": (1, 8, hidden),
+    }
+    linear(shapes, "init_x_linear", hidden, 16)
+    linear(shapes, "cond_seq_linear", hidden, 2048, bias=False)
+    linear(shapes, "t_embedder.mlp.0", hidden, 256)
+    linear(shapes, "t_embedder.mlp.2", hidden, hidden)
+
+    def attention(pfx, weights):
+        for w in weights:
+            linear(shapes, f"{pfx}.attn.{w}", hidden, hidden, bias=False)
+
+    def feed_forward(pfx):
+        linear(shapes, f"{pfx}.c_fc1", mlp, hidden, bias=False)
+        linear(shapes, f"{pfx}.c_fc2", mlp, hidden, bias=False)
+        linear(shapes, f"{pfx}.c_proj", hidden, mlp, bias=False)
+
+    for i in range(double_layers):
+        pfx = f"double_layers.{i}"
+        linear(shapes, f"{pfx}.modX.1", hidden * 6, hidden, bias=False)
+        linear(shapes, f"{pfx}.modC.1", hidden * 6, hidden, bias=False)
+        attention(pfx, ["w1q", "w1k", "w1v", "w1o", "w2q", "w2k", "w2v", "w2o"])
+        feed_forward(f"{pfx}.mlpX")
+        feed_forward(f"{pfx}.mlpC")
+    for i in range(single_layers):
+        pfx = f"single_layers.{i}"
+        linear(shapes, f"{pfx}.modCX.1", hidden * 6, hidden, bias=False)
+        attention(pfx, ["w1q", "w1k", "w1v", "w1o"])
+        feed_forward(f"{pfx}.mlp")
+    linear(shapes, "modF.1", hidden * 2, hidden, bias=False)
+    linear(shapes, "final_linear", 16, hidden, bias=False)
+    return shapes
+
+def ltxv_shapes(scale=1.0, depth=28):
+    """Key layout and shapes of an LTX-Video model (the depth is fixed, detection looks for block 27)"""
+    hidden = 128 * max(1, round(16 * scale))
+    shapes = {"scale_shift_table": (2, hidden)}
+    linear(shapes, "patchify_proj", hidden, 128)
+    linear(shapes, "adaln_single.emb.timestep_embedder.linear_1", hidden, 256)
+    linear(shapes, "adaln_single.emb.timestep_embedder.linear_2", hidden, hidden)
+    linear(shapes, "adaln_single.linear", hidden * 6, hidden)
+    linear(shapes, "caption_projection.linear_1", hidden, 4096)
+    linear(shapes, "caption_projection.linear_2", hidden, hidden)
+    for i in range(depth):
+        pfx = f"transformer_blocks.{i}"
+        shapes[f"{pfx}.scale_shift_table"] = (6, hidden)
+        for attn in ["attn1", "attn2"]:
+            for proj in ["to_q", "to_k", "to_v", "to_out.0"]:
+                linear(shapes, f"{pfx}.{attn}.{proj}", hidden, hidden)
+            shapes[f"{pfx}.{attn}.q_norm.weight"] = (hidden,)
+            shapes[f"{pfx}.{attn}.k_norm.weight"] = (hidden,)
+        linear(shapes, f"{pfx}.ff.net.0.proj", hidden * 4, hidden)
+        linear(shapes, f"{pfx}.ff.net.2", hidden, hidden * 4)
+    linear(shapes, "proj_out", 128, hidden)
+    return shapes
+
+def unet_shapes(channels, channel_mult, transformer_depth, context_dim, adm_in_channels=None, conv_proj=False):
+    """Key layout and shapes of an SD1/SDXL style UNet (original, non-diffusers format)"""
+    shapes = {}
+    time_dim = channels * 4
+    linear(shapes, "time_embed.0", time_dim, channels)
+    linear(shapes, "time_embed.2", time_dim, time_dim)
+    if adm_in_channels:
+        linear(shapes, "label_emb.0.0", time_dim, adm_in_channels)
+        linear(shapes, "label_emb.0.2", time_dim, time_dim)
+
+    def conv(name, out_ch, in_ch, kernel=3):
+        shapes[f"{name}.weight"] = (out_ch, in_ch, kernel, kernel)
+        shapes[f"{name}.bias"] = (out_ch,)
+
+    def norm(name, ch):
+        shapes[f"{name}.weight"] = (ch,)
+        shapes[f"{name}.bias"] = (ch,)
+
+    def res_block(pfx, in_ch, out_ch):
+        norm(f"{pfx}.in_layers.0", in_ch)
+        conv(f"{pfx}.in_layers.2", out_ch, in_ch)
+        linear(shapes, f"{pfx}.emb_layers.1", out_ch, time_dim)
+        norm(f"{pfx}.out_layers.0", out_ch)
+        conv(f"{pfx}.out_layers.3", out_ch, out_ch)
+        if in_ch != out_ch:
+            conv(f"{pfx}.skip_connection", out_ch, in_ch, kernel=1)
+
+    def spatial_transformer(pfx, ch, depth):
+        norm(f"{pfx}.norm", ch)
+        for proj in ["proj_in", "proj_out"]:
+            if conv_proj:
+                conv(f"{pfx}.{proj}", ch, ch, kernel=1)
+            else:
+                linear(shapes, f"{pfx}.{proj}", ch, ch)
+        for b in range(depth):
+            block = f"{pfx}.transformer_blocks.{b}"
+            for attn, kv_dim in [("attn1", ch), ("attn2", context_dim)]:
+                linear(shapes, f"{block}.{attn}.to_q", ch, ch, bias=False)
+                linear(shapes, f"{block}.{attn}.to_k", ch, kv_dim, bias=False)
+                linear(shapes, f"{block}.{attn}.to_v", ch, kv_dim, bias=False)
+                linear(shapes, f"{block}.{attn}.to_out.0", ch, ch)
+            linear(shapes, f"{block}.ff.net.0.proj", ch * 8, ch)
+            linear(shapes, f"{block}.ff.net.2", ch, ch * 4)
+            for n in ["norm1", "norm2", "norm3"]:
+                norm(f"{block}.{n}", ch)
+
+    conv("input_blocks.0.0", channels, 4)
+    skip_channels = [channels]
+    ch, index = channels, 1
+    for level, mult in enumerate(channel_mult):
+        for _ in range(2):
+            res_block(f"input_blocks.{index}.0", ch, channels * mult)
+            ch = channels * mult
+            if transformer_depth[level]:
+                spatial_transformer(f"input_blocks.{index}.1", ch, transformer_depth[level])
+            skip_channels.append(ch)
+            index += 1
+        if level != len(channel_mult) - 1:
+            conv(f"input_blocks.{index}.0.op", ch, ch)
+            skip_channels.append(ch)
+            index += 1
+
+    res_block("middle_block.0", ch, ch)
+    spatial_transformer("middle_block.1", ch, transformer_depth[-1])
+    res_block("middle_block.2", ch, ch)
+
+    index = 0
+    for level, mult in reversed(list(enumerate(channel_mult))):
+        for i in range(3):
+            res_block(f"output_blocks.{index}.0", ch + skip_channels.pop(), channels * mult)
+            ch = channels * mult
+            layer = 1
+            if transformer_depth[level]:
+                spatial_transformer(f"output_blocks.{index}.1", ch, transformer_depth[level])
+                layer = 2
+            if level and i == 2:
+                conv(f"output_blocks.{index}.{layer}.conv", ch, ch)
+            index += 1
+
+    norm("out.0", ch)
+    conv("out.2", 4, ch)
+    return shapes
+
+def sdxl_shapes(scale=1.0):
+    channels = 32 * max(1, round(10 * scale))
+    depth = [0] + [max(1, round(n * scale)) for n in (2, 10)]
+    return unet_shapes(channels, (1, 2, 4), depth, 2048, adm_in_channels=2816)
+
+def sd1_shapes(scale=1.0):
+    channels = 32 * max(1, round(10 * scale))
+    return unet_shapes(channels, (1, 2, 4, 4), (1, 1, 1, 0), 768, conv_proj=True)
+
+# architecture -> generator of its key layout at a given scale, matching the templates in model_index.py
+ARCH_SHAPES = {
+    "flux": flux_shapes,
+    "sd3": sd3_shapes,
+    "aura": aura_shapes,
+    "ltxv": ltxv_shapes,
+    "sdxl": sdxl_shapes,
+    "sd1": sd1_shapes,
+}
+
+DTYPES = {
+    "BF16": torch.bfloat16,
+    "F16": torch.float16,
+    "F32": torch.float32,
+    # this is so we don't break torch 2.0.X
+    "F8_E4M3": getattr(torch, "float8_e4m3fn", None),
+}
+
+def make_state_dict(shapes, dtype=torch.bfloat16, prefix="model.diffusion_model."):
+    """Random tensors with the given shapes, named like a checkpoint saved from ComfyUI"""
+    generator = torch.Generator().manual_seed(0)
+    return {
+        f"{prefix}{key}": torch.randn(shape, generator=generator).to(dtype)
+        for key, shape in shapes.items()
+    }
+
+def convert_file(src, dst, jobs=1, max_memory=convert.DEFAULT_MAX_MEMORY, qtype=None):
+    writer, state_dict, model_arch = convert.load_model(src)
+    writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
+    convert.write_gguf(dst, writer, state_dict, model_arch, qtype=qtype, jobs=jobs, max_memory=max_memory)
+
+def bench_jobs(args):
+    qtype = None if args.qtype == "none" else args.qtype
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "flux.safetensors")
+        save_file(make_state_dict(flux_shapes(scale=args.scale), DTYPES[args.dtype]), src)
+        print(f"* Synthetic flux model: {os.path.getsize(src) / 1024**3:.2f} GiB {args.dtype} (scale {args.scale}), "
+              f"converted to {qtype or 'F16/BF16'}")
+
+        results = []
+        for jobs in args.jobs:
+            dst = os.path.join(tmp, f"flux-{jobs}.gguf")
+            start = time.perf_counter()
+            # the per-tensor log lines would drown out the results
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                convert_file(src, dst, jobs=jobs, max_memory=args.max_memory, qtype=qtype)
+            results.append((jobs, time.perf_counter() - start))
+            os.remove(dst)
+
+    print(f"\n{'jobs':>6} {'seconds':>10} {'speedup':>8}")
+    for jobs, elapsed in results:
+        print(f"{jobs:>6} {elapsed:>10.2f} {results[0][1] / elapsed:>7.2f}x")
+
+def legacy_convert_tensor(plan, data):
+    """The conversion path before the copy-free dtype layer, for comparison"""
+    if data.dtype == torch.bfloat16:
+        data = data.to(torch.float32).numpy()
+    elif data.dtype in [getattr(torch, "float8_e4m3fn", "_invalid"), getattr(torch, "float8_e5m2", "_invalid")]:
+        data = data.to(torch.float16).numpy()
+    else:
+        data = data.numpy()
+    if plan.orig_shape is not None:
+        data = data.reshape(plan.shape)
+    return gguf.quants.quantize(data, plan.qtype)
+
+def read_proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+def measure(func, *args):
+    """Returns wall-clock seconds and peak memory in bytes allocated while running func(*args)"""
+    if os.path.exists("/proc/self/clear_refs"):
+        # linux: reset the peak RSS watermark so torch allocations are counted too
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        baseline = read_proc_status("VmRSS")
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        return elapsed, read_proc_status("VmHWM") - baseline
+
+    # elsewhere only numpy buffers are visible, through tracemalloc
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+def bench_dtype(args):
+    shape = tuple(args.shape)
+    print(f"{'source':>8} {'target':>6} {'path':>7} {'MB/s':>9} {'peak MB':>9}")
+    for name, dtype in DTYPES.items():
+        if dtype is None:
+            continue
+        data = torch.randn(shape).to(dtype)
+        src_mb = data.numel() * data.element_size() / 1024**2
+        native = convert.NATIVE_QTYPES.get(name, gguf.GGMLQuantizationType.F16)
+        for qtype in dict.fromkeys([native, gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.Q8_0]):
+            plan = convert.TensorPlan("bench.weight", shape, name, qtype)
+            for path, func in [("legacy", legacy_convert_tensor), ("current", convert.convert_tensor)]:
+                elapsed, peak = measure(func, plan, data)
+                print(f"{name:>8} {qtype.name:>6} {path:>7} {src_mb / elapsed:>9.0f} {peak / 1024**2:>9.1f}")
+
+def bench_errors(args):
+    dtype = DTYPES[args.dtype]
+    data = torch.randn(tuple(args.shape)).to(dtype)
+    src_mb = data.numel() * data.element_size() / 1024**2
+    print(f"{'target':>6} {'MB/s':>9} {'analyzed':>9} {'overhead':>9} {'peak MB':>9} {'analyzed':>9} {'RMSE':>9} {'SNR dB':>7}")
+    for name in args.qtypes:
+        plan = convert.TensorPlan("bench.weight", data.shape, args.dtype, getattr(gguf.GGMLQuantizationType, name))
+        elapsed, peak = measure(convert.convert_tensor, plan, data)
+        error = TensorError()
+        analyzed, analyzed_peak = measure(convert.convert_tensor, plan, data, None, error)
+        metrics = error.to_dict()
+        snr = "-" if metrics["snr_db"] is None else f"{metrics['snr_db']:.1f}"
+        print(
+            f"{name:>6} {src_mb / elapsed:>9.0f} {src_mb / analyzed:>9.0f} {analyzed / elapsed - 1:>+9.0%} "
+            f"{peak / 1024**2:>9.1f} {analyzed_peak / 1024**2:>9.1f} {metrics['rmse']:>9.2e} {snr:>7}"
+        )
+
+# startup paths, each timed in a fresh interpreter so nothing is imported yet
+IMPORT_CASES = {
+    "python": "pass",
+    "model_index": "import model_index",
+    "pipeline": "import pipeline",
+    "convert": "import convert",
+    "probe (import)": "import torch, tqdm, safetensors, gguf, sentencepiece, yaml, numpy",
+    "probe (find_spec)": "import importlib.util; [importlib.util.find_spec(name) for name in "
+                         "['torch', 'tqdm', 'safetensors', 'gguf', 'sentencepiece', 'yaml', 'numpy']]",
+    # up to the first drawn window, without waiting for anyone to close it
+    "gui window": "import tkinter, runpy; tkinter.Tk.mainloop = lambda self, n=0: (self.update(), self.destroy()); "
+                  "runpy.run_path('EasyQuantizationGUI.py', run_name='__main__')",
+}
+
+def bench_imports(args):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'case':>18} {'best s':>8} {'median s':>9}")
+    for name, code in IMPORT_CASES.items():
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", code], cwd=base_dir, capture_output=True, text=True)
+            times.append(time.perf_counter() - start)
+            if process.returncode != 0:
+                break
+        if process.returncode != 0:
+            error = (process.stderr.strip().splitlines() or ["unknown error"])[-1]
+            print(f"{name:>18}  failed: {error}")
+            continue
+        times.sort()
+        print(f"{name:>18} {times[0]:>8.3f} {times[len(times) // 2]:>9.3f}")
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def bench_file(src, dst, jobs=1, max_memory=convert.DEFAULT_MAX_MEMORY):
+    """Converts src to dst one step at a time, returning the seconds spent in each"""
+    timings = {}
+    start = time.perf_counter()
+    state_dict = convert.load_state_dict(src)
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model_arch = convert.detect_arch(state_dict)
+    timings["detect"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    writer = gguf.GGUFWriter(path=None, arch=model_arch.arch)
+    writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
+    plans = convert.plan_tensors(writer, state_dict, model_arch)
+    writer.write_header_to_file(path=dst)
+    writer.write_kv_data_to_file()
+    writer.write_ti_data_to_file()
+    writer.close()
+    timings["plan"] = time.perf_counter() - start
+
+    trace = convert.RunTrace()
+    convert.handle_tensors(dst, state_dict, plans, writer.data_alignment, jobs=jobs, max_memory=max_memory, trace=trace)
+    timings["tensors"] = trace.wall_seconds
+    timings["write"] = trace.summary()["seconds"]["write"]
+    return timings
+
+def bench_suite(args):
+    print(f"{'arch':>5} {'dtype':>7} {'scale':>6} {'MB':>8} {'load':>7} {'detect':>7} {'plan':>7} {'tensors':>8} {'write':>7} {'MB/s':>7} {'peak MB':>8}")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for arch in args.archs:
+            for scale in args.scales:
+                shapes = ARCH_SHAPES[arch](scale)
+                for dtype_name in args.dtypes:
+                    dtype = DTYPES[dtype_name]
+                    if dtype is None:
+                        print(f"* Skipping {dtype_name}, not supported by this torch version")
+                        continue
+                    src = os.path.join(tmp, f"{arch}.safetensors")
+                    dst = os.path.join(tmp, f"{arch}.gguf")
+                    save_file(make_state_dict(shapes, dtype), src)
+
+                    timings = {}
+                    # the per-tensor log lines and progress bars would drown out the results
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+                        elapsed, peak = measure(lambda: timings.update(bench_file(src, dst, args.jobs, args.max_memory)))
+                    results.append({
+                        "arch": arch,
+                        "dtype": dtype_name,
+                        "scale": scale,
+                        "tensors": len(shapes),
+                        "src_bytes": os.path.getsize(src),
+                        "dst_bytes": os.path.getsize(dst),
+                        "seconds": {name: round(value, 4) for name, value in timings.items()},
+                        "total_seconds": round(elapsed, 4),
+                        "peak_bytes": peak,
+                    })
+                    os.remove(src)
+                    os.remove(dst)
+                    print_result(results[-1])
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        compare_results(baseline["results"], results)
+
+    output = args.output or f"benchmark-{git_commit()}.json"
+    with open(output, "w") as f:
+        json.dump({
+            "commit": git_commit(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "jobs": args.jobs,
+            "results": results,
+        }, f, indent=2)
+    print(f"* Results written to {output}")
+
+def result_key(result):
+    return (result["arch"], result["dtype"], result["scale"])
+
+def print_result(result):
+    seconds = result["seconds"]
+    src_mb = result["src_bytes"] / 1024**2
+    print(
+        f"{result['arch']:>5} {result['dtype']:>7} {result['scale']:>6} {src_mb:>8.1f} {seconds['load']:>7.3f} "
+        f"{seconds['detect']:>7.3f} {seconds['plan']:>7.3f} {seconds['tensors']:>8.3f} {seconds['write']:>7.3f} "
+        f"{src_mb / result['total_seconds']:>7.0f} {result['peak_bytes'] / 1024**2:>8.1f}"
+    )
+
+def compare_results(baseline, results):
+    """Prints the change in total time and peak memory for every configuration present in both runs"""
+    previous = {result_key(result): result for result in baseline}
+    print(f"\n{'arch':>5} {'dtype':>7} {'scale':>6} {'time':>8} {'peak':>8}")
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        time_change = result["total_seconds"] / old["total_seconds"] - 1 if old["total_seconds"] else 0.0
+        peak_change = result["peak_bytes"] / old["peak_bytes"] - 1 if old["peak_bytes"] else 0.0
+        print(f"{result['arch']:>5} {result['dtype']:>7} {result['scale']:>6} {time_change:>+8.1%} {peak_change:>+8.1%}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for the GGUF conversion pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    jobs = subparsers.add_parser("jobs", help="Wall-clock scaling of handle_tensors() by --jobs")
+    jobs.add_argument("--scale", type=float, default=0.25, help="Width/depth of the synthetic model relative to Flux.")
+    jobs.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8], help="Job counts to compare.")
+    jobs.add_argument("--max-memory", type=float, default=convert.DEFAULT_MAX_MEMORY, help="Memory budget in GiB.")
+    # a plain F16/BF16 conversion mostly copies bytes, quantizing is the work --jobs spreads out
+    jobs.add_argument("--qtype", choices=convert.PYTHON_QTYPES + ["none"], default="Q8_0", help="Type to convert to, none for the default F16/BF16 output.")
+    jobs.add_argument("--dtype", choices=["BF16", "F16", "F32"], default="BF16", help="Source dtype of the synthetic model.")
+    jobs.set_defaults(func=bench_jobs)
+
+    dtype = subparsers.add_parser("dtype", help="Throughput and peak allocation of the per-tensor dtype conversion")
+    dtype.add_argument("--shape", type=int, nargs="+", default=[3072, 12288], help="Shape of the test tensor.")
+    dtype.set_defaults(func=bench_dtype)
+
+    errors = subparsers.add_parser("errors", help="Cost of measuring the quantization error while converting")
+    errors.add_argument("--shape", type=int, nargs="+", default=[3072, 12288], help="Shape of the test tensor.")
+    errors.add_argument("--dtype", choices=["BF16", "F16", "F32"], default="BF16", help="Source dtype of the test tensor.")
+    errors.add_argument("--qtypes", nargs="+", choices=convert.PYTHON_QTYPES, default=convert.PYTHON_QTYPES, help="Target types to compare.")
+    errors.set_defaults(func=bench_errors)
+
+    imports = subparsers.add_parser("imports", help="Cold start time of the GUI and the modules it imports")
+    imports.add_argument("--repeat", type=int, default=5, help="Runs of each case, the best and median are shown.")
+    imports.set_defaults(func=bench_imports)
+
+    suite = subparsers.add_parser("suite", help="Conversion time and peak memory of synthetic models of every architecture")
+    suite.add_argument("--archs", nargs="+", choices=list(ARCH_SHAPES), default=list(ARCH_SHAPES), help="Architectures to generate.")
+    suite.add_argument("--dtypes", nargs="+", choices=list(DTYPES), default=list(DTYPES), help="Source dtypes to generate.")
+    suite.add_argument("--scales", type=float, nargs="+", default=[0.1, 0.25], help="Model sizes relative to the real architectures.")
+    suite.add_argument("--jobs", type=int, default=1, help="Tensors converted in parallel.")
+    suite.add_argument("--max-memory", type=float, default=convert.DEFAULT_MAX_MEMORY, help="Memory budget in GiB.")
+    suite.add_argument("--output", help="JSON file for the results, defaults to benchmark-<commit>.json.")
+    suite.add_argument("--compare", help="Results of an earlier run to compare against.")
+    suite.set_defaults(func=bench_suite)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,195 @@
+import os
+import re
+import sys
+import json
+import struct
+import hashlib
+import threading
+
+from model_index import source_files, model_name
+
+DEFAULT_QUOTA_GB = 100
+HEADER_HASH_LIMIT = 16 * 1024**2 # never hash more than this much of the source when fingerprinting it
+
+def default_cache_dir():
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "EasyQuantizationGUI", "conversions")
+
+def default_quota_gb():
+    value = os.environ.get("EASYQUANT_CACHE_QUOTA_GB")
+    if value is None:
+        return DEFAULT_QUOTA_GB
+    try:
+        quota_gb = float(value)
+    except ValueError:
+        quota_gb = None
+    if quota_gb is None or not quota_gb >= 0: # also rejects nan
+        print(f"Ignoring EASYQUANT_CACHE_QUOTA_GB={value!r}, it has to be a number of GB. Using {DEFAULT_QUOTA_GB} GB.", file=sys.stderr)
+        return DEFAULT_QUOTA_GB
+    return quota_gb
+
+CONVERTER_FILES = ["convert.py", "model_index.py", "quant_policy.py"]
+
+def converter_version():
+    """Hash of the converter sources, so any change to them invalidates old entries"""
+    sha = hashlib.sha256()
+    for name in CONVERTER_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+def source_header(path):
+    """The safetensors JSON header (names, dtypes, shapes, offsets), or the start of any other file"""
+    with open(path, "rb") as f:
+        length_bytes = f.read(8)
+        if len(length_bytes) == 8:
+            (length,) = struct.unpack("<Q", length_bytes)
+            if length <= HEADER_HASH_LIMIT and f.read(1) == b"{":
+                f.seek(8)
+                return length_bytes + f.read(length)
+        f.seek(0)
+        return f.read(1024**2)
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "header": hashlib.sha256(source_header(path)).hexdigest(),
+    }
+
+class ConversionCache:
+    """
+    On-disk cache of F16/BF16 GGUF files produced by convert.py, keyed by the
+    source files (size, mtime and header hash) and the converter version.
+    The least recently used entries are evicted once the cache exceeds its quota.
+    """
+    def __init__(self, cache_dir=None, quota_gb=None):
+        self.cache_dir = cache_dir or os.environ.get("EASYQUANT_CACHE_DIR") or default_cache_dir()
+        if quota_gb is None:
+            quota_gb = default_quota_gb()
+        self.quota = int(quota_gb * 1024**3)
+        self.in_use = {} # path -> number of jobs still reading it, never evicted
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, src):
+        # for a sharded model src is only the index, its shards can change on their own
+        fingerprint = json.dumps({
+            "files": [file_fingerprint(path) for path in source_files(src)],
+            "converter": converter_version(),
+        }, sort_keys=True)
+        return hashlib.sha256(fingerprint.encode()).hexdigest()[:32]
+
+    def entry_path(self, src):
+        return os.path.join(self.cache_dir, f"{model_name(src)}-{self.key(src)}.gguf")
+
+    def partial_path(self, src):
+        # convert.py writes here first, so an interrupted conversion never looks like a valid entry
+        return self.entry_path(src) + ".partial"
+
+    def acquire(self, path):
+        self.in_use[path] = self.in_use.get(path, 0) + 1
+
+    def release(self, path):
+        """Ends the use of an entry returned by lookup() or store()"""
+        with self.lock:
+            self.in_use[path] -= 1
+            if not self.in_use[path]:
+                del self.in_use[path]
+
+    def lookup(self, src):
+        path = self.entry_path(src)
+        with self.lock:
+            if not os.path.isfile(path):
+                return None
+            os.utime(path) # mark as most recently used
+            self.acquire(path)
+        return path
+
+    def store(self, src, partial_path):
+        path = self.entry_path(src)
+        with self.lock:
+            os.replace(partial_path, path)
+            self.acquire(path)
+        self.evict()
+        return path
+
+    def start_conversion(self, src):
+        """
+        Path convert.py should write the entry for src to, held until released.
+        Partials of the same model under another key (the source or converter
+        changed since) can't be resumed any more and are removed.
+        """
+        partial = self.partial_path(src)
+        # <model name>-<key>.gguf.partial, the key being 32 hex digits
+        stale = re.compile(re.escape(model_name(src)) + r"-[0-9a-f]{32}\.gguf\.partial")
+        with self.lock:
+            self.acquire(partial)
+            for path, _ in self.entries():
+                if stale.fullmatch(os.path.basename(path)) and path not in self.in_use:
+                    try:
+                        self.remove(path)
+                    except OSError:
+                        pass
+        self.evict()
+        return partial
+
+    def entries(self):
+        """
+        Cached files and partial conversions, least recently used first. A
+        partial's journal is counted (and evicted) with it.
+        """
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isfile(path):
+                continue
+            if name.endswith(".gguf.partial.journal"):
+                path = path[:-len(".journal")]
+            elif not name.endswith((".gguf", ".gguf.partial")):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue # removed in the meantime
+            mtime, size = entries.get(path, (0, 0))
+            entries[path] = (max(mtime, stat.st_mtime), size + stat.st_size)
+        return [(path, size) for path, (_, size) in sorted(entries.items(), key=lambda item: item[1][0])]
+
+    def size(self):
+        return sum(size for _, size in self.entries())
+
+    def remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        if path.endswith(".partial") and os.path.exists(path + ".journal"):
+            os.remove(path + ".journal")
+
+    def clear(self):
+        """Removes every entry and partial conversion that isn't in use, returns the bytes freed"""
+        before = self.size()
+        self.evict(quota=0)
+        return before - self.size()
+
+    def evict(self, keep=None, quota=None):
+        quota = self.quota if quota is None else quota
+        with self.lock:
+            entries = self.entries()
+            total = sum(size for _, size in entries)
+            evicted = []
+            for path, size in entries:
+                if total <= quota:
+                    break
+                if path == keep or path in self.in_use:
+                    continue
+                try:
+                    self.remove(path)
+                except OSError:
+                    continue # still open in another process, e.g. on Windows
+                total -= size
+                evicted.append(path)
+            return evicted
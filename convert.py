@@ -1,248 +1,806 @@
 # (c) City96 || Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 import os
-import torch
+import sys
+import json
+import math
+import hashlib
+import time
+import threading
 import gguf
 import argparse
-from tqdm import tqdm
+import numpy as np # already loaded by gguf
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+# torch, safetensors and tqdm are imported where tensors are loaded or converted,
+# planning only needs names, dtype names and shapes (see ModelIndex)
+from model_index import ModelIndex, detect_arch, map_keys, is_shard_index, read_shard_index, source_files, model_name, MAX_SHARD_THREADS, DTYPE_SIZES
+from conversion_cache import converter_version
+from quant_policy import load_policy
+from quant_error import TensorError, ErrorReport
+from verify_gguf import expected_from_plans, verify_gguf
 
-from safetensors.torch import load_file
-
-QUANTIZATION_THRESHOLD = 1024
-REARRANGE_THRESHOLD = 512
 MAX_TENSOR_NAME_LENGTH = 127
+DEFAULT_MAX_MEMORY = 4 # GiB of tensors allowed in flight when converting in parallel
+CONVERT_CHUNK_SIZE = 16 * 1024**2 # bytes of float32 upcast at a time when a tensor has to be converted
+CONVERT_PIECE_SIZE = 256 * 1024**2 # source bytes loaded at a time, larger tensors are split into pieces of whole rows
+DEFAULT_SHARD_JOBS = 4 # default --jobs for sharded models, so reads from different shards overlap
 
-class ModelTemplate:
-    arch = "invalid"  # string describing architecture
-    shape_fix = False # whether to reshape tensors
-    keys_detect = []  # list of lists to match in state dict
-    keys_banned = []  # list of keys that should mark model as invalid for conversion
-
-class ModelFlux(ModelTemplate):
-    arch = "flux"
-    keys_detect = [
-        ("transformer_blocks.0.attn.norm_added_k.weight",),
-        ("double_blocks.0.img_attn.proj.weight",),
-    ]
-    keys_banned = ["transformer_blocks.0.attn.norm_added_k.weight",]
-
-class ModelSD3(ModelTemplate):
-    arch = "sd3"
-    keys_detect = [
-        ("transformer_blocks.0.attn.add_q_proj.weight",),
-        ("joint_blocks.0.x_block.attn.qkv.weight",),
-    ]
-    keys_banned = ["transformer_blocks.0.attn.add_q_proj.weight",]
-
-class ModelAura(ModelTemplate):
-    arch = "aura"
-    keys_detect = [
-        ("double_layers.3.modX.1.weight",),
-        ("joint_transformer_blocks.3.ff_context.out_projection.weight",),
-    ]
-    keys_banned = ["joint_transformer_blocks.3.ff_context.out_projection.weight",]
-
-class ModelLTXV(ModelTemplate):
-    arch = "ltxv"
-    keys_detect = [
-        (
-            "adaln_single.emb.timestep_embedder.linear_2.weight",
-            "transformer_blocks.27.scale_shift_table",
-            "caption_projection.linear_2.weight",
-        )
-    ]
-
-class ModelSDXL(ModelTemplate):
-    arch = "sdxl"
-    shape_fix = True
-    keys_detect = [
-        ("down_blocks.0.downsamplers.0.conv.weight", "add_embedding.linear_1.weight",),
-        (
-            "input_blocks.3.0.op.weight", "input_blocks.6.0.op.weight",
-            "output_blocks.2.2.conv.weight", "output_blocks.5.2.conv.weight",
-        ), # Non-diffusers
-        ("label_emb.0.0.weight",),
-    ]
-
-class ModelSD1(ModelTemplate):
-    arch = "sd1"
-    shape_fix = True
-    keys_detect = [
-        ("down_blocks.0.downsamplers.0.conv.weight",),
-        (
-            "input_blocks.3.0.op.weight", "input_blocks.6.0.op.weight", "input_blocks.9.0.op.weight",
-            "output_blocks.2.1.conv.weight", "output_blocks.5.2.conv.weight", "output_blocks.8.2.conv.weight"
-        ), # Non-diffusers
-    ]
-
-# The architectures are checked in order and the first successful match terminates the search.
-arch_list = [ModelFlux, ModelSD3, ModelAura, ModelLTXV,  ModelSDXL, ModelSD1]
-
-def is_model_arch(model, state_dict):
-    # check if model is correct
-    matched = False
-    invalid = False
-    for match_list in model.keys_detect:
-        if all(key in state_dict for key in match_list):
-            matched = True
-            invalid = any(key in state_dict for key in model.keys_banned)
-            break
-    assert not invalid, "Model architecture not allowed for conversion! (i.e. reference VS diffusers format)"
-    return matched
-
-def detect_arch(state_dict):
-    model_arch = None
-    for arch in arch_list:
-        if is_model_arch(arch, state_dict):
-            model_arch = arch
-            break
-    assert model_arch is not None, "Unknown model architecture!"
-    return model_arch
+# output types that gguf.quants can produce without llama-quantize
+PYTHON_QTYPES = ["F16", "BF16", "Q8_0", "Q5_1", "Q5_0", "Q4_1", "Q4_0"]
+# qtypes a policy rule can ask for, gguf-py can't quantize the K types
+POLICY_QTYPES = ["F32"] + PYTHON_QTYPES
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate F16 GGUF files from single UNET")
-    parser.add_argument("--src", required=True, help="Source model ckpt file.")
+    parser.add_argument("--src", required=True, help="Source model ckpt file, or the model.safetensors.index.json of a sharded one.")
     parser.add_argument("--dst", help="Output unet gguf file.")
+    parser.add_argument("--qtype", choices=PYTHON_QTYPES, help="Quantize directly to this type instead of writing an F16/BF16 file.")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite the output file without asking.")
+    parser.add_argument("--jobs", type=int, help="Number of tensors to convert in parallel, defaults to 1 (one per shard up to 4 for sharded models).")
+    parser.add_argument("--max-memory", type=float, default=DEFAULT_MAX_MEMORY, help="Memory budget in GiB for tensors being converted in parallel.")
+    parser.add_argument("--trace", help="Write per-tensor stage timings and sizes to this JSONL file.")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted conversion to the same output from its journal.")
+    parser.add_argument("--policy", help="YAML/JSON file with precision rules on top of the architecture's defaults.")
+    parser.add_argument("--error-report", help="Measure the RMSE/max/SNR of every lossy tensor and write them as JSON to this file.")
     args = parser.parse_args()
 
     if not os.path.isfile(args.src):
         parser.error("No input provided!")
+    if args.policy and not os.path.isfile(args.policy):
+        parser.error(f"Policy file not found: {args.policy}")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1!")
 
     return args
 
-def load_state_dict(path):
-    if any(path.endswith(x) for x in [".ckpt", ".pt", ".bin", ".pth"]):
-        state_dict = torch.load(path, map_location="cpu", weights_only=True)
-        state_dict = state_dict.get("model", state_dict)
-    else:
-        state_dict = load_file(path)
+def torch_dtype_names():
+    """torch dtype -> safetensors dtype name, for checkpoints loaded through torch"""
+    import torch
+    names = {
+        torch.float64: "F64",
+        torch.float32: "F32",
+        torch.float16: "F16",
+        torch.bfloat16: "BF16",
+        torch.int64: "I64",
+        torch.int32: "I32",
+        torch.int16: "I16",
+        torch.int8: "I8",
+        torch.uint8: "U8",
+        torch.bool: "BOOL",
+    }
+    # this is so we don't break torch 2.0.X
+    for attr, name in [("float8_e4m3fn", "F8_E4M3"), ("float8_e5m2", "F8_E5M2")]:
+        if hasattr(torch, attr):
+            names[getattr(torch, attr)] = name
+    return names
+
+class LazyStateDict(Mapping):
+    """
+    Read-only state dict that resolves tensor names up front but only loads a
+    tensor when it is accessed, so a model never has to fit in memory at once.
+    """
+    def __init__(self, keys):
+        self.key_map = map_keys(keys)
+
+    def __getitem__(self, key):
+        return self.load_tensor(self.key_map[key])
+
+    def __contains__(self, key):
+        # must not go through __getitem__, that would load the tensor
+        return key in self.key_map
+
+    def __iter__(self):
+        return iter(self.key_map)
+
+    def __len__(self):
+        return len(self.key_map)
+
+    def get_shape(self, key):
+        raise NotImplementedError
+
+    def get_dtype(self, key):
+        """safetensors dtype name, e.g. BF16"""
+        raise NotImplementedError
+
+    def load_tensor(self, name):
+        raise NotImplementedError
+
+    def load_rows(self, key, start, stop):
+        """Loads only tensor[start:stop], along the first dimension"""
+        return self[key][start:stop]
+
+class SafetensorsStateDict(LazyStateDict):
+    def __init__(self, path):
+        from safetensors import safe_open
+        # safe_open memory maps the file and only parses the header here
+        self.handle = safe_open(path, framework="pt", device="cpu")
+        super().__init__(list(self.handle.keys()))
+
+    def handle_for(self, name):
+        return self.handle
+
+    def get_shape(self, key):
+        name = self.key_map[key]
+        return tuple(self.handle_for(name).get_slice(name).get_shape())
+
+    def get_dtype(self, key):
+        name = self.key_map[key]
+        return self.handle_for(name).get_slice(name).get_dtype()
+
+    def load_tensor(self, name):
+        return self.handle_for(name).get_tensor(name)
+
+    def load_rows(self, key, start, stop):
+        # reads just these rows from the file instead of the whole tensor
+        name = self.key_map[key]
+        return self.handle_for(name).get_slice(name)[start:stop]
+
+class ShardedStateDict(SafetensorsStateDict):
+    """Safetensors checkpoint split over several files, listed in a model.safetensors.index.json"""
+    def __init__(self, path):
+        from safetensors import safe_open
+        weight_map = read_shard_index(path)
+        self.shards = sorted(set(weight_map.values()))
+        with ThreadPoolExecutor(max_workers=min(len(self.shards), MAX_SHARD_THREADS)) as pool:
+            handles = dict(zip(self.shards, pool.map(lambda shard: safe_open(shard, framework="pt", device="cpu"), self.shards)))
+        self.handles = {name: handles[shard] for name, shard in weight_map.items()}
+        # sorted like the keys of a single safetensors file, so a model converts the same sharded or not
+        LazyStateDict.__init__(self, sorted(weight_map))
+
+    def handle_for(self, name):
+        return self.handles[name]
+
+class TorchStateDict(LazyStateDict):
+    def __init__(self, path):
+        import torch
+        try:
+            # zip based checkpoints can be memory mapped so storages are only paged in on access
+            state_dict = torch.load(path, map_location="cpu", weights_only=True, mmap=True)
+        except (RuntimeError, TypeError):
+            # legacy (non-zip) format or torch without mmap support
+            state_dict = torch.load(path, map_location="cpu", weights_only=True)
+        self.state_dict = state_dict.get("model", state_dict)
+        self.dtype_names = torch_dtype_names()
+        super().__init__(list(self.state_dict.keys()))
+
+    def get_shape(self, key):
+        return tuple(self.state_dict[self.key_map[key]].shape)
 
-    # only keep unet with no prefix!
-    prefix = None
-    for pfx in ["model.diffusion_model.", "model."]:
-        if any([x.startswith(pfx) for x in state_dict.keys()]):
-            prefix = pfx
-            break
+    def get_dtype(self, key):
+        return self.dtype_names[self.state_dict[self.key_map[key]].dtype]
 
-    sd = {}
-    for k, v in state_dict.items():
-        if prefix and prefix not in k:
-            continue
-        if prefix:
-            k = k.replace(prefix, "")
-        sd[k] = v
+    def load_tensor(self, name):
+        return self.state_dict[name]
 
-    return sd
+def load_state_dict(path):
+    if any(path.endswith(x) for x in [".ckpt", ".pt", ".bin", ".pth"]):
+        return TorchStateDict(path)
+    if is_shard_index(path):
+        return ShardedStateDict(path)
+    return SafetensorsStateDict(path)
+
+def default_jobs(state_dict):
+    if isinstance(state_dict, ShardedStateDict):
+        return min(len(state_dict.shards), DEFAULT_SHARD_JOBS)
+    return 1
 
 def load_model(path):
+    try:
+        index = ModelIndex.from_file(path)
+    except ValueError:
+        index = None # legacy (non-zip) torch checkpoints have no header to read
+    # reject unsupported models from the header alone, before opening the weights
+    model_arch = detect_arch(index) if index is not None else None
     state_dict = load_state_dict(path)
-    model_arch = detect_arch(state_dict)
+    model_arch = model_arch or detect_arch(state_dict)
     print(f"* Architecture detected from input: {model_arch.arch}")
     writer = gguf.GGUFWriter(path=None, arch=model_arch.arch)
     return (writer, state_dict, model_arch)
 
-def handle_tensors(args, writer, state_dict, model_arch):
+class TensorPlan:
+    """Output name, shape and qtype of a single tensor, decided from metadata only"""
+    def __init__(self, key, shape, old_dtype, qtype, orig_shape=None, fallback_from=None):
+        self.key = key
+        self.shape = shape           # shape as written, after any rearranging
+        self.old_dtype = old_dtype   # safetensors dtype name of the source
+        self.qtype = qtype
+        self.orig_shape = orig_shape # set if the tensor was rearranged
+        self.fallback_from = fallback_from # qtype that was wanted but couldn't be used
+
+    @property
+    def byte_shape(self):
+        if not self.shape:
+            return () # a scalar, only ever F32/F16/BF16
+        return gguf.quant_shape_to_byte_shape(self.shape, self.qtype)
+
+    @property
+    def n_params(self):
+        n_params = 1
+        for dim_size in self.shape:
+            n_params *= dim_size
+        return n_params
+
+    @property
+    def nbytes(self):
+        n_bytes = 1 if self.shape else gguf.GGML_QUANT_SIZES[self.qtype][1]
+        for dim_size in self.byte_shape:
+            n_bytes *= dim_size
+        return n_bytes
+
+    @property
+    def src_nbytes(self):
+        return self.n_params * DTYPE_SIZES[self.old_dtype]
+
+    @property
+    def peak_memory(self):
+        # loaded source tensor + converted output + one upcast chunk
+        return self.src_nbytes + self.nbytes + CONVERT_CHUNK_SIZE
+
+    def pieces(self, piece_size=CONVERT_PIECE_SIZE):
+        """
+        Ranges along the first dimension of the source tensor that are loaded,
+        converted and written one at a time. Each range covers whole output rows,
+        so it is aligned to the qtype's blocks and converts exactly like the
+        same rows of the whole tensor would.
+        """
+        src_shape = self.orig_shape or self.shape
+        if len(src_shape) < 2 or self.src_nbytes <= piece_size:
+            return [(0, src_shape[0] if src_shape else 1)]
+        row_params = self.n_params // src_shape[0]
+        # smallest step along the first dimension that ends on an output row
+        step = self.shape[-1] // math.gcd(row_params, self.shape[-1])
+        step_bytes = self.src_nbytes // src_shape[0] * step
+        size = max(1, piece_size // step_bytes) * step
+        return [(start, min(start + size, src_shape[0])) for start in range(0, src_shape[0], size)]
+
+    def piece_memory(self, start, stop):
+        rows = (self.orig_shape or self.shape or (1,))[0]
+        if not rows:
+            return CONVERT_CHUNK_SIZE # an empty tensor, nothing to load
+        fraction = (stop - start) / rows
+        return int((self.src_nbytes + self.nbytes) * fraction) + CONVERT_CHUNK_SIZE
+
+def can_quantize(shape, qtype):
+    block_size, _ = gguf.GGML_QUANT_SIZES[qtype]
+    if not shape:
+        return block_size == 1 # a scalar only fits the float types
+    return shape[-1] % block_size == 0
+
+def plan_tensor(key, data_shape, old_dtype, model_arch, qtype=None, policy=None):
+    policy = policy or model_arch.policy
+    n_dims = len(data_shape)
+    data_qtype = getattr(
+        gguf.GGMLQuantizationType,
+        "BF16" if old_dtype == "BF16" else "F16"
+    )
+
+    # get number of parameters (AKA elements) in this tensor
+    n_params = 1
+    for dim_size in data_shape:
+        n_params *= dim_size
+
+    # keys to keep as max precision
+    keep_f32 = policy.keeps_f32(key)
+
+    if old_dtype in ("F32", "BF16"):
+        if n_dims == 1:
+            # one-dimensional tensors should be kept in F32
+            # also speeds up inference due to not dequantizing
+            data_qtype = gguf.GGMLQuantizationType.F32
+
+        elif n_params <= policy.quantization_threshold:
+            # very small tensors
+            data_qtype = gguf.GGMLQuantizationType.F32
+
+        elif keep_f32:
+            data_qtype = gguf.GGMLQuantizationType.F32
+
+    if (qtype is not None                           # Quantizing directly instead of via llama-quantize
+        and data_qtype != gguf.GGMLQuantizationType.F32
+        and n_dims > 1                              # Same rules as above, but also for F16 inputs
+        and n_params > policy.quantization_threshold
+        and not keep_f32
+    ):
+        data_qtype = getattr(gguf.GGMLQuantizationType, qtype)
+
+    # user rules come last, a quantized type still needs a tensor that can be quantized
+    override = policy.override(key, n_params, old_dtype, quantizing=qtype is not None)
+    if override is not None and (n_dims > 1 or override in ("F32", "F16", "BF16")):
+        data_qtype = getattr(gguf.GGMLQuantizationType, override)
+
+    orig_shape = None
+    if (model_arch.shape_fix                        # NEVER reshape for models such as flux
+        and n_dims > 1                              # Skip one-dimensional tensors
+        and n_params >= policy.rearrange_threshold  # Only rearrange tensors meeting the size requirement
+        and (n_params / 256).is_integer()           # Rearranging only makes sense if total elements is divisible by 256
+        and not (data_shape[-1] / 256).is_integer() # Only need to rearrange if the last dimension is not divisible by 256
+    ):
+        orig_shape = data_shape
+        data_shape = (n_params // 256, 256)
+
+    # the tensor layout is fixed before any data is written, so the fallback has to be decided here
+    fallback_from = None
+    if not can_quantize(data_shape, data_qtype):
+        fallback_from = data_qtype
+        data_qtype = gguf.GGMLQuantizationType.F16
+
+    return TensorPlan(key, data_shape, old_dtype, data_qtype, orig_shape, fallback_from)
+
+def plan_model(state_dict, model_arch, qtype=None, policy=None):
+    return [
+        plan_tensor(key, state_dict.get_shape(key), state_dict.get_dtype(key), model_arch, qtype, policy)
+        for key in state_dict.keys()
+    ]
+
+def plan_tensors(writer, state_dict, model_arch, qtype=None, policy=None):
+    """
+    First pass: decide the layout of every tensor from names, shapes and dtypes
+    and register it with the writer, without loading any tensor data.
+    """
     name_lengths = tuple(sorted(
         ((key, len(key)) for key in state_dict.keys()),
         key=lambda item: item[1],
         reverse=True,
     ))
     if not name_lengths:
-        return
+        return []
     max_name_len = name_lengths[0][1]
     if max_name_len > MAX_TENSOR_NAME_LENGTH:
         bad_list = ", ".join(f"{key!r} ({namelen})" for key, namelen in name_lengths if namelen > MAX_TENSOR_NAME_LENGTH)
         raise ValueError(f"Can only handle tensor names up to {MAX_TENSOR_NAME_LENGTH} characters. Tensors exceeding the limit: {bad_list}")
-    for key, data in tqdm(state_dict.items()):
-        old_dtype = data.dtype
-
-        if data.dtype == torch.bfloat16:
-            data = data.to(torch.float32).numpy()
-        # this is so we don't break torch 2.0.X
-        elif data.dtype in [getattr(torch, "float8_e4m3fn", "_invalid"), getattr(torch, "float8_e5m2", "_invalid")]:
-            data = data.to(torch.float16).numpy()
-        else:
-            data = data.numpy()
-
-        n_dims = len(data.shape)
-        data_shape = data.shape
-        data_qtype = getattr(
-            gguf.GGMLQuantizationType,
-            "BF16" if old_dtype == torch.bfloat16 else "F16"
-        )
-
-        # get number of parameters (AKA elements) in this tensor
-        n_params = 1
-        for dim_size in data_shape:
-            n_params *= dim_size
 
-        # keys to keep as max precision
-        blacklist = {
-            "time_embedding.",
-            "add_embedding.",
-            "time_in.",
-            "txt_in.",
-            "vector_in.",
-            "img_in.",
-            "guidance_in.",
-            "final_layer.",
+    from tqdm import tqdm
+    plans = plan_model(state_dict, model_arch, qtype, policy)
+    for plan in plans:
+        if plan.fallback_from is not None:
+            tqdm.write(f"falling back to F16: Can't quantize tensor {plan.key!r} with shape {plan.shape} to {plan.fallback_from.name}")
+        if plan.orig_shape is not None:
+            writer.add_array(f"comfy.gguf.orig_shape.{plan.key}", tuple(int(dim) for dim in plan.orig_shape))
+        # the writer reads a uint8 shape as bytes per row, which a scalar doesn't have
+        writer.add_tensor_info(plan.key, plan.byte_shape, np.uint8 if plan.shape else np.float32, plan.nbytes, raw_dtype=plan.qtype)
+    return plans
+
+def estimate_file_size(plans, arch, alignment=gguf.GGUF_DEFAULT_ALIGNMENT):
+    """Size in bytes of the GGUF file write_gguf() produces for these plans"""
+    def padded(size):
+        return size + (-size % alignment)
+
+    def kv_size(key, value_size):
+        return 8 + len(key.encode()) + 4 + value_size # key string, value type, value
+
+    # magic, version, tensor count, kv count, then the architecture, quantization version and file type
+    size = 24 + kv_size("general.architecture", 8 + len(arch.encode()))
+    size += kv_size("general.quantization_version", 4) + kv_size("general.file_type", 4)
+    for plan in plans:
+        if plan.orig_shape is not None:
+            # int32 array: element type, count, elements
+            size += kv_size(f"comfy.gguf.orig_shape.{plan.key}", 4 + 8 + 4 * len(plan.orig_shape))
+        # name, dimension count, dimensions, type, offset
+        size += 8 + len(plan.key.encode()) + 4 + 8 * len(plan.byte_shape) + 4 + 8
+    return padded(size) + sum(padded(plan.nbytes) for plan in plans)
+
+def estimate_peak_memory(plans, jobs=1, max_memory=DEFAULT_MAX_MEMORY):
+    """Peak bytes of tensor data held by handle_tensors(), following its memory budget"""
+    if not plans:
+        return 0
+    sizes = sorted((plan.piece_memory(*piece) for plan in plans for piece in plan.pieces()), reverse=True)
+    # up to jobs + 1 pieces are in flight, but no more than the budget unless a single one exceeds it
+    return max(sizes[0], min(sum(sizes[:jobs + 1]), int(max_memory * 1024**3)))
+
+TRACE_STAGES = ["load", "reshape", "cast", "quantize", "analyze", "write"]
+
+class TensorTrace:
+    """Time spent in each stage of converting one tensor, plus its sizes"""
+    def __init__(self, plan):
+        self.plan = plan
+        self.seconds = dict.fromkeys(TRACE_STAGES, 0.0)
+        self.lock = threading.Lock() # pieces of one tensor can be converted at the same time
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[name] += time.perf_counter() - start
+
+    def to_dict(self):
+        plan = self.plan
+        return {
+            "type": "tensor",
+            "key": plan.key,
+            "old_dtype": str(plan.old_dtype),
+            "qtype": plan.qtype.name,
+            "shape": list(plan.shape),
+            "orig_shape": None if plan.orig_shape is None else list(plan.orig_shape),
+            "fallback_from": None if plan.fallback_from is None else plan.fallback_from.name,
+            "bytes_in": plan.src_nbytes,
+            "bytes_out": plan.nbytes,
+            "seconds": {name: round(value, 6) for name, value in self.seconds.items()},
+        }
+
+class RunTrace:
+    """
+    Per-tensor traces of a handle_tensors() run, in write order. Written as
+    JSONL (one line per tensor, then a summary line) for tools and CI, and
+    summarized as text for the log.
+    """
+    def __init__(self):
+        self.tensors = []
+        self.start = time.perf_counter()
+        self.wall_seconds = 0.0
+
+    def add(self, plan):
+        trace = TensorTrace(plan)
+        self.tensors.append(trace)
+        return trace
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.start
+
+    def summary(self):
+        return {
+            "type": "summary",
+            "tensors": len(self.tensors),
+            "bytes_in": sum(trace.plan.src_nbytes for trace in self.tensors),
+            "bytes_out": sum(trace.plan.nbytes for trace in self.tensors),
+            "wall_seconds": round(self.wall_seconds, 6),
+            # summed over tensors, so with --jobs > 1 stages can add up to more than the wall time
+            "seconds": {name: round(sum(trace.seconds[name] for trace in self.tensors), 6) for name in TRACE_STAGES},
+            "fallbacks": [trace.plan.key for trace in self.tensors if trace.plan.fallback_from is not None],
+            "reshaped": [trace.plan.key for trace in self.tensors if trace.plan.orig_shape is not None],
         }
 
-        if old_dtype in (torch.float32, torch.bfloat16):
-            if n_dims == 1:
-                # one-dimensional tensors should be kept in F32
-                # also speeds up inference due to not dequantizing
-                data_qtype = gguf.GGMLQuantizationType.F32
-
-            elif n_params <= QUANTIZATION_THRESHOLD:
-                # very small tensors
-                data_qtype = gguf.GGMLQuantizationType.F32
-
-            elif ".weight" in key and any(x in key for x in blacklist):
-                data_qtype = gguf.GGMLQuantizationType.F32
-
-        if (model_arch.shape_fix                        # NEVER reshape for models such as flux
-            and n_dims > 1                              # Skip one-dimensional tensors
-            and n_params >= REARRANGE_THRESHOLD         # Only rearrange tensors meeting the size requirement
-            and (n_params / 256).is_integer()           # Rearranging only makes sense if total elements is divisible by 256
-            and not (data.shape[-1] / 256).is_integer() # Only need to rearrange if the last dimension is not divisible by 256
-        ):
-            orig_shape = data.shape
-            data = data.reshape(n_params // 256, 256)
-            writer.add_array(f"comfy.gguf.orig_shape.{key}", tuple(int(dim) for dim in orig_shape))
+    def write(self, path):
+        with open(path, "w") as f:
+            for trace in self.tensors:
+                f.write(json.dumps(trace.to_dict()) + "\n")
+            f.write(json.dumps(self.summary()) + "\n")
+
+    def format_summary(self):
+        summary = self.summary()
+        wall = summary["wall_seconds"] or float("inf")
+        lines = [
+            f"* Converted {summary['tensors']} tensors, {summary['bytes_in'] / 1024**3:.2f} GB -> "
+            f"{summary['bytes_out'] / 1024**3:.2f} GB in {summary['wall_seconds']:.1f}s "
+            f"({summary['bytes_in'] / 1024**2 / wall:.0f} MB/s)"
+        ]
+        for name, seconds in summary["seconds"].items():
+            lines.append(f"  {name:<8} {seconds:>8.2f}s")
+        if summary["fallbacks"]:
+            lines.append(f"  {len(summary['fallbacks'])} tensors fell back to F16")
+        return "\n".join(lines)
+
+# source dtypes that can be written out as-is when the target type matches
+NATIVE_QTYPES = {
+    "F32": gguf.GGMLQuantizationType.F32,
+    "F16": gguf.GGMLQuantizationType.F16,
+    "BF16": gguf.GGMLQuantizationType.BF16,
+}
+
+def tensor_rows(data):
+    """
+    Zero-copy 2D view of a tensor's elements, plus a function that upcasts a slice
+    of those rows to something numpy and gguf.quants can work with.
+    """
+    import torch
+    data = data.contiguous()
+    if data.dtype == torch.bfloat16:
+        # numpy has no bfloat16, so keep the raw bits and widen them to float32 on demand
+        rows = data.view(torch.int16).numpy().view(np.uint16)
+        upcast = lambda chunk: np.left_shift(chunk, 16, dtype=np.uint32).view(np.float32)
+    # this is so we don't break torch 2.0.X
+    elif data.dtype in [getattr(torch, "float8_e4m3fn", "_invalid"), getattr(torch, "float8_e5m2", "_invalid")]:
+        # numpy has no float8 either, torch does the upcast
+        rows = data
+        upcast = lambda chunk: chunk.to(torch.float16).numpy()
+    else:
+        rows = data.numpy()
+        upcast = lambda chunk: chunk
+    return rows.reshape(-1, data.shape[-1] if data.dim() else 1), upcast
+
+def is_lossless(plan):
+    return plan.qtype in (gguf.GGMLQuantizationType.F32, NATIVE_QTYPES.get(plan.old_dtype))
+
+def convert_tensor(plan, data, trace=None, error=None):
+    """
+    Converts a tensor, or a piece of it from plan.pieces(), to the planned qtype.
+    If `error` (a TensorError) is given, each converted chunk is dequantized
+    again and compared to the source.
+    """
+    stage = trace.stage if trace is not None else lambda name: nullcontext()
+
+    if plan.orig_shape is not None:
+        with stage("reshape"):
+            data = data.reshape(-1, plan.shape[-1])
+
+    row_nbytes = plan.byte_shape[-1] if plan.shape else plan.nbytes
+    if NATIVE_QTYPES.get(plan.old_dtype) == plan.qtype:
+        # same storage format, write the loaded bytes without any conversion
+        rows, _ = tensor_rows(data)
+        assert rows.nbytes == rows.shape[0] * row_nbytes, f"{plan.key}: expected {rows.shape[0] * row_nbytes} bytes, got {rows.nbytes}"
+        return rows
+
+    # upcast and quantize a few rows at a time instead of making a float32 copy of the whole tensor,
+    # every supported type quantizes rows independently so the result is the same
+    rows, upcast = tensor_rows(data)
+    chunk_rows = max(1, CONVERT_CHUNK_SIZE // (rows.shape[1] * 4))
+    if plan.qtype in (gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16):
+        # plain float targets are filled in place, numpy casts on assignment
+        out = np.empty(rows.shape, dtype=np.float32 if plan.qtype == gguf.GGMLQuantizationType.F32 else np.float16)
+        for start in range(0, rows.shape[0], chunk_rows):
+            with stage("cast"):
+                chunk = upcast(rows[start:start + chunk_rows])
+                out[start:start + chunk_rows] = chunk
+            if error is not None:
+                with stage("analyze"):
+                    error.add(chunk, out[start:start + chunk_rows])
+        return out
+
+    out = np.empty((rows.shape[0], row_nbytes), dtype=np.uint8)
+    for start in range(0, rows.shape[0], chunk_rows):
+        with stage("cast"):
+            chunk = upcast(rows[start:start + chunk_rows])
+        with stage("quantize"):
+            quantized = gguf.quants.quantize(chunk, plan.qtype)
+            out[start:start + chunk_rows] = quantized.view(np.uint8).reshape(quantized.shape[0], -1)
+        if error is not None:
+            # only this chunk is dequantized, so measuring never doubles the tensor in memory
+            with stage("analyze"):
+                error.add(chunk, gguf.quants.dequantize(quantized, plan.qtype))
+    return out
+
+class TensorDataWriter:
+    """Appends tensor data to a GGUF file whose header and tensor info were already written"""
+    def __init__(self, path, alignment):
+        self.alignment = alignment
+        self.fout = open(path, "r+b")
+        self.fout.seek(0, os.SEEK_END)
+        self.write_padding()
+
+    def write_padding(self):
+        pad = -self.fout.tell() % self.alignment
+        if pad:
+            self.fout.write(bytes(pad))
+
+    def write(self, data):
+        data.tofile(self.fout)
+
+    def flush(self):
+        self.fout.flush()
+        return self.fout.tell()
+
+    def write_tensor(self, data):
+        self.write(data)
+        self.write_padding()
+
+    def close(self):
+        self.fout.close()
+
+class ConversionJournal:
+    """
+    JSONL sidecar next to the output file. The first line identifies the source,
+    converter and tensor layout. After that there is one line per completely
+    written tensor with the output offset it ends at, so an interrupted
+    conversion can be continued from the last one.
+    """
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.fout = None
+
+    @staticmethod
+    def make_fingerprint(src, plans, alignment):
+        layout = json.dumps([alignment] + [[plan.key, list(plan.shape), plan.qtype.name] for plan in plans])
+        # the shards of a sharded model can change without touching its index
+        files = [(os.path.abspath(path), os.stat(path)) for path in source_files(src)]
+        return {
+            "source": os.path.abspath(src),
+            "files": [[path, stat.st_size, stat.st_mtime_ns] for path, stat in files],
+            "converter": converter_version(),
+            "layout": hashlib.sha256(layout.encode()).hexdigest(),
+        }
 
+    def resume_point(self, out_path, plans):
+        """Number of plans already in out_path and the offset after them, or None if it has to start over"""
+        entries = []
         try:
-            data = gguf.quants.quantize(data, data_qtype)
-        except (AttributeError, gguf.QuantError) as e:
-            tqdm.write(f"falling back to F16: {e}")
-            data_qtype = gguf.GGMLQuantizationType.F16
-            data = gguf.quants.quantize(data, data_qtype)
-
-        new_name = key # do we need to rename?
-
-        shape_str = f"{{{', '.join(str(n) for n in reversed(data.shape))}}}"
-        tqdm.write(f"{f'%-{max_name_len + 4}s' % f'{new_name}'} {old_dtype} --> {data_qtype.name}, shape = {shape_str}")
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break # torn last line from a crash, the tensors before it are still good
+        except OSError:
+            return None
+        if not entries or entries[0] != {"type": "header", **self.fingerprint}:
+            return None
+        done = entries[1:]
+        if not done or len(done) > len(plans) or any(entry.get("key") != plan.key for entry, plan in zip(done, plans)):
+            return None
+        end = done[-1]["end"]
+        if not os.path.isfile(out_path) or os.path.getsize(out_path) < end:
+            return None
+        return len(done), end
+
+    def start(self):
+        self.fout = open(self.path, "w")
+        self.fout.write(json.dumps({"type": "header", **self.fingerprint}) + "\n")
+        self.fout.flush()
+
+    def resume(self):
+        self.fout = open(self.path, "a")
+
+    def record(self, key, end):
+        self.fout.write(json.dumps({"type": "tensor", "key": key, "end": end}) + "\n")
+        self.fout.flush()
+
+    def close(self):
+        if self.fout is not None and not self.fout.closed:
+            self.fout.close()
+
+def load_and_convert(state_dict, plan, piece=None, trace=None, error=None):
+    with trace.stage("load") if trace is not None else nullcontext():
+        data = state_dict[plan.key] if piece is None else state_dict.load_rows(plan.key, *piece)
+    return convert_tensor(plan, data, trace, error)
+
+def handle_tensors(out_path, state_dict, plans, alignment=gguf.GGUF_DEFAULT_ALIGNMENT, jobs=1, max_memory=DEFAULT_MAX_MEMORY, trace=None, piece_size=CONVERT_PIECE_SIZE, journal=None, report=None):
+    """
+    Second pass: load, convert and write each tensor straight to its slot in the
+    output file. Tensors over `piece_size` bytes are split into pieces of whole
+    rows. Up to `jobs` tensors or pieces are converted at once, as long as their
+    estimated footprint stays within `max_memory` GiB, but they are always
+    written in plan order so the output is identical for any number of jobs.
+    Stage timings are recorded in `trace` (a RunTrace), finished tensors in
+    `journal` (a ConversionJournal) and the error of every lossy conversion in
+    `report` (an ErrorReport) if given.
+    """
+    if not plans:
+        return
 
-        writer.add_tensor(new_name, data, raw_dtype=data_qtype)
+    from tqdm import tqdm
+    max_name_len = max(len(plan.key) for plan in plans)
+    budget = int(max_memory * 1024**3)
+    fout = TensorDataWriter(out_path, alignment)
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    pending = deque()
+    in_flight = 0
+    try:
+        with tqdm(total=len(plans)) as pbar:
+            def write_oldest():
+                nonlocal in_flight
+                plan, tensor_trace, error, cost, is_last, future = pending.popleft()
+                data = future.result()
+                in_flight -= cost
+
+                with tensor_trace.stage("write") if tensor_trace is not None else nullcontext():
+                    fout.write(data)
+                    if is_last:
+                        fout.write_padding()
+                del data
+                if not is_last:
+                    return
+                if journal is not None:
+                    # the data has to reach the file before the journal says it's there
+                    journal.record(plan.key, fout.flush())
+                if error is not None:
+                    report.add(plan, error)
+
+                shape_str = f"{{{', '.join(str(n) for n in reversed(plan.shape))}}}"
+                tqdm.write(f"{f'%-{max_name_len + 4}s' % f'{plan.key}'} {plan.old_dtype} --> {plan.qtype.name}, shape = {shape_str}")
+                pbar.update(1)
+
+            for plan in plans:
+                tensor_trace = trace.add(plan) if trace is not None else None
+                error = TensorError() if report is not None and not is_lossless(plan) else None
+                pieces = plan.pieces(piece_size)
+                for i, piece in enumerate(pieces):
+                    cost = plan.piece_memory(*piece)
+                    # a piece larger than the whole budget still runs, just on its own
+                    while pending and (len(pending) > jobs or in_flight + cost > budget):
+                        write_oldest()
+                    # whole tensors are loaded as before, only split ones go through load_rows()
+                    future = pool.submit(load_and_convert, state_dict, plan, piece if len(pieces) > 1 else None, tensor_trace, error)
+                    pending.append((plan, tensor_trace, error, cost, i == len(pieces) - 1, future))
+                    in_flight += cost
+
+            while pending:
+                write_oldest()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        fout.close()
+        if trace is not None:
+            trace.finish()
+
+def write_gguf(out_path, writer, state_dict, model_arch, qtype=None, jobs=1, max_memory=DEFAULT_MAX_MEMORY, trace=None, src=None, resume=False, policy=None, report=None):
+    """
+    Writes the GGUF file. If `src` is given, progress is journaled next to the
+    output, and with `resume` a previous run of the same conversion is continued
+    from its last completed tensor (only the remaining tensors end up in `report`).
+    Returns the plans of all tensors in the file.
+    """
+    plans = plan_tensors(writer, state_dict, model_arch, qtype, policy)
+    journal = None
+    done = None
+    if src is not None:
+        journal = ConversionJournal(out_path + ".journal", ConversionJournal.make_fingerprint(src, plans, writer.data_alignment))
+        done = journal.resume_point(out_path, plans) if resume else None
+
+    todo = plans
+    if done is None:
+        writer.write_header_to_file(path=out_path)
+        writer.write_kv_data_to_file()
+        writer.write_ti_data_to_file()
+        writer.close()
+        if journal is not None:
+            journal.start()
+    else:
+        count, end = done
+        print(f"* Resuming after {count} of {len(plans)} tensors")
+        # drop whatever was written of the tensor that was interrupted
+        os.truncate(out_path, end)
+        journal.resume()
+        todo = plans[count:]
+
+    try:
+        handle_tensors(out_path, state_dict, todo, writer.data_alignment, jobs=jobs, max_memory=max_memory, trace=trace, journal=journal, report=report)
+    finally:
+        if journal is not None:
+            journal.close()
+    if journal is not None:
+        os.remove(journal.path)
+    return plans
 
 if __name__ == "__main__":
     args = parse_args()
     path = args.src
     writer, state_dict, model_arch = load_model(path)
+    policy = None
+    if args.policy:
+        try:
+            policy = load_policy(args.policy, model_arch.arch, model_arch.policy, POLICY_QTYPES)
+        except ValueError as e:
+            sys.exit(f"Invalid policy: {e}")
 
     writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
-    if next(iter(state_dict.values())).dtype == torch.bfloat16:
-        out_path = f"{os.path.splitext(path)[0]}-BF16.gguf"
+    # next to the source, named after it without the extension(s)
+    out_base = os.path.join(os.path.dirname(path), model_name(path))
+    if args.qtype:
+        out_path = f"{out_base}-{args.qtype}.gguf"
+        writer.add_file_type(getattr(gguf.LlamaFileType, f"MOSTLY_{args.qtype}"))
+    elif state_dict.get_dtype(next(iter(state_dict))) == "BF16":
+        out_path = f"{out_base}-BF16.gguf"
         writer.add_file_type(gguf.LlamaFileType.MOSTLY_BF16)
     else:
-        out_path = f"{os.path.splitext(path)[0]}-F16.gguf"
+        out_path = f"{out_base}-F16.gguf"
         writer.add_file_type(gguf.LlamaFileType.MOSTLY_F16)
 
     out_path = args.dst or out_path
-    if os.path.isfile(out_path):
+    # an interrupted conversion to this output is continued rather than replaced
+    resuming = args.resume and os.path.isfile(out_path + ".journal")
+    if os.path.isfile(out_path) and not (args.overwrite or resuming):
+        if sys.stdin is None or not sys.stdin.isatty():
+            # nobody to answer the prompt, don't hang waiting for one
+            sys.exit(f"Output exists: {out_path} (use --overwrite to replace it)")
         input("Output exists enter to continue or ctrl+c to abort!")
 
-    handle_tensors(path, writer, state_dict, model_arch)
-    writer.write_header_to_file(path=out_path)
-    writer.write_kv_data_to_file()
-    writer.write_tensors_to_file(progress=True)
-    writer.close()
+    trace = RunTrace()
+    report = ErrorReport() if args.error_report else None
+    plans = write_gguf(out_path, writer, state_dict, model_arch, qtype=args.qtype, jobs=args.jobs or default_jobs(state_dict), max_memory=args.max_memory,
+               trace=trace, src=path, resume=args.resume, policy=policy, report=report)
+    print(trace.format_summary())
+    if args.trace:
+        trace.write(args.trace)
+    if report is not None:
+        print(report.format_summary())
+        report.write(args.error_report)
+
+    # reread the header through a memory map, catches a truncated or inconsistent file before anything loads it
+    problems = verify_gguf(out_path, expected_from_plans(plans), model_arch.arch)
+    if problems:
+        sys.exit("Output verification failed:\n" + "\n".join(problems))
+    print(f"* Verified {len(plans)} tensors in {out_path}")
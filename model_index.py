@@ -0,0 +1,318 @@
+# (c) City96 || Apache-2.0 (apache.org/licenses/LICENSE-2.0)
+"""
+Architecture detection from tensor names alone. The index is read from the
+safetensors JSON header or the pickle manifest of a zip torch checkpoint, so
+no weights are loaded and neither torch nor safetensors is imported.
+"""
+import os
+import json
+import pickle
+import struct
+import zipfile
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from quant_policy import DEFAULT_POLICY
+
+MAX_HEADER_SIZE = 100 * 1024**2 # same limit as the safetensors library
+SHARD_INDEX_SUFFIX = ".index.json" # model.safetensors.index.json of a checkpoint split into shards
+MAX_SHARD_THREADS = 8 # shards whose headers are read at once
+
+class ModelTemplate:
+    arch = "invalid"  # string describing architecture
+    shape_fix = False # whether to reshape tensors
+    keys_detect = []  # list of lists to match in state dict
+    keys_banned = []  # list of keys that should mark model as invalid for conversion
+    policy = DEFAULT_POLICY # which tensors to keep in high precision or quantize, see quant_policy.py
+
+class ModelFlux(ModelTemplate):
+    arch = "flux"
+    keys_detect = [
+        ("transformer_blocks.0.attn.norm_added_k.weight",),
+        ("double_blocks.0.img_attn.proj.weight",),
+    ]
+    keys_banned = ["transformer_blocks.0.attn.norm_added_k.weight",]
+
+class ModelSD3(ModelTemplate):
+    arch = "sd3"
+    keys_detect = [
+        ("transformer_blocks.0.attn.add_q_proj.weight",),
+        ("joint_blocks.0.x_block.attn.qkv.weight",),
+    ]
+    keys_banned = ["transformer_blocks.0.attn.add_q_proj.weight",]
+
+class ModelAura(ModelTemplate):
+    arch = "aura"
+    keys_detect = [
+        ("double_layers.3.modX.1.weight",),
+        ("joint_transformer_blocks.3.ff_context.out_projection.weight",),
+    ]
+    keys_banned = ["joint_transformer_blocks.3.ff_context.out_projection.weight",]
+
+class ModelLTXV(ModelTemplate):
+    arch = "ltxv"
+    keys_detect = [
+        (
+            "adaln_single.emb.timestep_embedder.linear_2.weight",
+            "transformer_blocks.27.scale_shift_table",
+            "caption_projection.linear_2.weight",
+        )
+    ]
+
+class ModelSDXL(ModelTemplate):
+    arch = "sdxl"
+    shape_fix = True
+    keys_detect = [
+        ("down_blocks.0.downsamplers.0.conv.weight", "add_embedding.linear_1.weight",),
+        (
+            "input_blocks.3.0.op.weight", "input_blocks.6.0.op.weight",
+            "output_blocks.2.2.conv.weight", "output_blocks.5.2.conv.weight",
+        ), # Non-diffusers
+        ("label_emb.0.0.weight",),
+    ]
+
+class ModelSD1(ModelTemplate):
+    arch = "sd1"
+    shape_fix = True
+    keys_detect = [
+        ("down_blocks.0.downsamplers.0.conv.weight",),
+        (
+            "input_blocks.3.0.op.weight", "input_blocks.6.0.op.weight", "input_blocks.9.0.op.weight",
+            "output_blocks.2.1.conv.weight", "output_blocks.5.2.conv.weight", "output_blocks.8.2.conv.weight"
+        ), # Non-diffusers
+    ]
+
+# The architectures are checked in order and the first successful match terminates the search.
+arch_list = [ModelFlux, ModelSD3, ModelAura, ModelLTXV,  ModelSDXL, ModelSD1]
+
+def is_model_arch(model, state_dict):
+    # check if model is correct
+    matched = False
+    invalid = False
+    for match_list in model.keys_detect:
+        if all(key in state_dict for key in match_list):
+            matched = True
+            invalid = any(key in state_dict for key in model.keys_banned)
+            break
+    assert not invalid, "Model architecture not allowed for conversion! (i.e. reference VS diffusers format)"
+    return matched
+
+def detect_arch(state_dict):
+    model_arch = None
+    for arch in arch_list:
+        if is_model_arch(arch, state_dict):
+            model_arch = arch
+            break
+    assert model_arch is not None, "Unknown model architecture!"
+    return model_arch
+
+def resolve_prefix(keys):
+    # only keep unet with no prefix!
+    for pfx in ["model.diffusion_model.", "model."]:
+        if any(x.startswith(pfx) for x in keys):
+            return pfx
+    return None
+
+
+def map_keys(keys):
+    """Tensor name as used for conversion -> name in the file"""
+    prefix = resolve_prefix(keys)
+    key_map = {}
+    for k in keys:
+        if prefix and prefix not in k:
+            continue
+        key_map[k.replace(prefix, "") if prefix else k] = k
+    return key_map
+
+def read_safetensors_header(path):
+    """name -> (dtype, shape) from the JSON header at the start of a safetensors file"""
+    with open(path, "rb") as f:
+        length_bytes = f.read(8)
+        if len(length_bytes) != 8:
+            raise ValueError(f"{path}: file too short for a safetensors header")
+        (length,) = struct.unpack("<Q", length_bytes)
+        if length > MAX_HEADER_SIZE:
+            raise ValueError(f"{path}: invalid safetensors header length {length}")
+        try:
+            header = json.loads(f.read(length))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f"{path}: invalid safetensors header: {e}") from e
+    header.pop("__metadata__", None)
+    return {name: (info["dtype"], tuple(info["shape"])) for name, info in header.items()}
+
+def is_shard_index(path):
+    return path.endswith(SHARD_INDEX_SUFFIX)
+
+def read_shard_index(path):
+    """name -> shard path from the weight_map of a model.safetensors.index.json"""
+    try:
+        with open(path) as f:
+            weight_map = json.load(f).get("weight_map")
+    except (UnicodeDecodeError, json.JSONDecodeError, AttributeError) as e:
+        raise ValueError(f"{path}: invalid shard index: {e}") from e
+    if not isinstance(weight_map, dict) or not weight_map:
+        raise ValueError(f"{path}: shard index has no weight_map")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    weight_map = {name: os.path.join(base_dir, shard) for name, shard in weight_map.items()}
+    missing = sorted(shard for shard in set(weight_map.values()) if not os.path.isfile(shard))
+    if missing:
+        raise ValueError(f"{path}: missing shards {missing}")
+    return weight_map
+
+def read_sharded_header(path):
+    """name -> (dtype, shape) of every tensor listed in a shard index, from the headers of its shards"""
+    weight_map = read_shard_index(path)
+    shards = sorted(set(weight_map.values()))
+    with ThreadPoolExecutor(max_workers=min(len(shards), MAX_SHARD_THREADS)) as pool:
+        headers = dict(zip(shards, pool.map(read_safetensors_header, shards)))
+    tensors = {}
+    for name in sorted(weight_map):
+        header = headers[weight_map[name]]
+        if name not in header:
+            raise ValueError(f"{path}: {name} not found in {weight_map[name]}")
+        tensors[name] = header[name]
+    return tensors
+
+def source_files(path):
+    """Every file a model is read from, the index and its shards for a sharded checkpoint"""
+    if is_shard_index(path):
+        return [path] + sorted(set(read_shard_index(path).values()))
+    return [path]
+
+def model_name(path):
+    """Base name for the outputs of a model, model.safetensors.index.json -> model"""
+    name = os.path.basename(path)
+    if is_shard_index(name):
+        name = name[:-len(SHARD_INDEX_SUFFIX)]
+    return os.path.splitext(name)[0]
+
+# torch storage classes in the pickle -> safetensors dtype names
+TORCH_STORAGE_DTYPES = {
+    "DoubleStorage": "F64",
+    "FloatStorage": "F32",
+    "HalfStorage": "F16",
+    "BFloat16Storage": "BF16",
+    "LongStorage": "I64",
+    "IntStorage": "I32",
+    "ShortStorage": "I16",
+    "CharStorage": "I8",
+    "ByteStorage": "U8",
+    "BoolStorage": "BOOL",
+    "Float8_e4m3fnStorage": "F8_E4M3",
+    "Float8_e5m2Storage": "F8_E5M2",
+}
+
+# safetensors dtype name -> bytes per element
+DTYPE_SIZES = {
+    "F64": 8,
+    "F32": 4,
+    "F16": 2,
+    "BF16": 2,
+    "I64": 8,
+    "I32": 4,
+    "I16": 2,
+    "I8": 1,
+    "U8": 1,
+    "BOOL": 1,
+    "F8_E4M3": 1,
+    "F8_E5M2": 1,
+}
+
+class TensorStub:
+    def __init__(self, dtype, shape):
+        self.dtype = dtype
+        self.shape = shape
+
+def rebuild_tensor(storage, storage_offset, size, stride, *args):
+    return TensorStub(storage, tuple(size))
+
+def rebuild_parameter(data, *args):
+    return data
+
+class ManifestUnpickler(pickle.Unpickler):
+    """
+    Unpickles a torch checkpoint's data.pkl into TensorStubs, without torch and
+    without touching the storages. Like torch.load(weights_only=True), any other
+    global is refused.
+    """
+    def find_class(self, module, name):
+        if (module, name) == ("collections", "OrderedDict"):
+            return OrderedDict
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return rebuild_tensor
+        if module == "torch._utils" and name == "_rebuild_parameter":
+            return rebuild_parameter
+        if module == "torch" and name in TORCH_STORAGE_DTYPES:
+            return TORCH_STORAGE_DTYPES[name]
+        raise pickle.UnpicklingError(f"Unsupported global in checkpoint: {module}.{name}")
+
+    def persistent_load(self, pid):
+        # ("storage", storage type, key, location, numel), the storage type was already mapped to a dtype
+        return pid[1]
+
+def read_torch_manifest(path):
+    """name -> (dtype, shape) from the pickle inside a zip based torch checkpoint"""
+    if not zipfile.is_zipfile(path):
+        raise ValueError(f"{path}: legacy (non-zip) torch checkpoints can only be read by loading them")
+    with zipfile.ZipFile(path) as archive:
+        manifest = next((name for name in archive.namelist() if name.endswith("data.pkl")), None)
+        if manifest is None:
+            raise ValueError(f"{path}: no data.pkl in checkpoint")
+        with archive.open(manifest) as f:
+            try:
+                state_dict = ManifestUnpickler(f).load()
+            except (pickle.UnpicklingError, AttributeError, TypeError, EOFError) as e:
+                raise ValueError(f"{path}: can't read checkpoint manifest: {e}") from e
+    if not isinstance(state_dict, dict):
+        raise ValueError(f"{path}: checkpoint is not a state dict")
+    state_dict = state_dict.get("model", state_dict)
+    return {name: (t.dtype, t.shape) for name, t in state_dict.items() if isinstance(t, TensorStub)}
+
+class ModelIndex(Mapping):
+    """
+    Names, dtypes and shapes of the tensors in a model file, keyed like the
+    state dicts in convert.py (checkpoint prefix removed). Values are
+    (dtype, shape) with safetensors dtype names.
+    """
+    def __init__(self, tensors):
+        self.tensors = tensors
+        self.key_map = map_keys(list(tensors))
+
+    @classmethod
+    def from_file(cls, path):
+        """Raises ValueError if the file has no header that can be read on its own"""
+        if any(path.endswith(x) for x in [".ckpt", ".pt", ".bin", ".pth"]):
+            return cls(read_torch_manifest(path))
+        if is_shard_index(path):
+            return cls(read_sharded_header(path))
+        return cls(read_safetensors_header(path))
+
+    def __getitem__(self, key):
+        return self.tensors[self.key_map[key]]
+
+    def __contains__(self, key):
+        return key in self.key_map
+
+    def __iter__(self):
+        return iter(self.key_map)
+
+    def __len__(self):
+        return len(self.key_map)
+
+    def get_shape(self, key):
+        return self[key][1]
+
+    def get_dtype(self, key):
+        return self[key][0]
+
+    @property
+    def n_params(self):
+        n_params = 0
+        for _, shape in self.values():
+            count = 1
+            for dim_size in shape:
+                count *= dim_size
+            n_params += count
+        return n_params
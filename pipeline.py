@@ -0,0 +1,671 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from conversion_cache import ConversionCache
+from model_index import ModelIndex, model_name
+
+QUANTIZE_LEVELS = ["Q2_K", "Q3_K_S", "Q4_0", "Q4_1", "Q4_K_S", "Q5_0", "Q5_1", "Q5_K_S", "Q6_K", "Q8_0", "F16"]
+# levels convert.py can produce in one pass with --qtype, without the temporary F16 file
+DIRECT_LEVELS = ["Q4_0", "Q4_1", "Q5_0", "Q5_1", "Q8_0", "F16"]
+TEMP_FILE_NAME = "temporary_file_during_quantization"
+LLAMA_QUANTIZE_NAME = "llama-quantize.exe" if os.name == "nt" else "llama-quantize"
+# tensor type llama-quantize uses for each level, for estimating output sizes
+LEVEL_QTYPES = {level: level for level in QUANTIZE_LEVELS}
+LEVEL_QTYPES.update({"Q3_K_S": "Q3_K", "Q4_K_S": "Q4_K", "Q5_K_S": "Q5_K"})
+
+LLAMA_QUANTIZE_BYTES_PER_PARAM = 8 # float32 copy of the tensor being quantized plus its work buffers
+PROCESS_OVERHEAD = 1024**3         # python + torch (or llama-quantize) before any tensor is loaded
+DISK_MARGIN = 1.05                 # headroom on top of the predicted sizes
+
+# exit codes of the command line runner
+EXIT_OK = 0
+EXIT_FAILED = 1       # at least one output failed
+EXIT_USAGE = 2        # bad arguments or manifest
+EXIT_NO_SPACE = 3     # the preflight check predicts the outputs won't fit
+EXIT_INTERRUPTED = 130
+
+def resource_path(relative_path):
+    """ Get absolute path to resource, works for dev and for PyInstaller """
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.dirname(os.path.abspath(__file__))
+
+    return os.path.join(base_path, relative_path)
+
+class Cancelled(Exception):
+    pass
+
+def process_options():
+    """Platform specific Popen arguments"""
+    if os.name == "nt":
+        # don't open a console window for every process
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = subprocess.SW_HIDE
+        return {"startupinfo": startupinfo}
+    return {}
+
+def run_process(args, log, prefix="", cancel=None):
+    """
+    Runs a command with a hidden console window, passing each output line to log().
+    The process is terminated if the `cancel` event is set while it runs.
+    """
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                               bufsize=1, universal_newlines=True, **process_options())
+
+    def watch_cancel():
+        # the process may be silent for a long time, so don't rely on the output loop to notice
+        while process.poll() is None:
+            if cancel.wait(0.2):
+                process.terminate()
+                return
+
+    if cancel is not None:
+        threading.Thread(target=watch_cancel, daemon=True).start()
+
+    for line in process.stdout:
+        log(prefix + line)
+
+    process.wait()
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+def output_path(src, out_dir, level):
+    return os.path.join(out_dir, f"{model_name(src)}-{level}.gguf")
+
+def convert_model(src, dst, log, qtype=None, prefix="", cancel=None, policy=None, error_report=None):
+    # continues an interrupted conversion to dst if its journal matches, otherwise starts over
+    args = [sys.executable, resource_path("convert.py"), "--src", src, "--dst", dst, "--overwrite", "--resume"]
+    if qtype:
+        args += ["--qtype", qtype]
+    if policy:
+        args += ["--policy", policy]
+    if error_report:
+        args += ["--error-report", error_report]
+    run_process(args, log, prefix=prefix, cancel=cancel)
+
+class LlamaQuantizeBackend:
+    """
+    Quantizes the converted F16/BF16 file with a llama-quantize binary, every
+    level is supported. It has to be built with ComfyUI-GGUF's lcpp.patch, a
+    stock llama.cpp build doesn't know the image model architectures.
+    """
+    name = "llama-quantize"
+    direct = False
+
+    def __init__(self, binary):
+        self.binary = binary
+
+    def supports(self, level):
+        return level in QUANTIZE_LEVELS
+
+    def describe(self):
+        return f"{self.name} ({self.binary})"
+
+    def quantize(self, src, dst, level, log, threads=None, cancel=None):
+        args = [self.binary, src, dst, level]
+        if threads:
+            args.append(str(threads))
+        run_process(args, log, prefix=f"[{level}] ", cancel=cancel)
+
+class PythonBackend:
+    """
+    Without llama-quantize, convert.py quantizes straight from the source with
+    gguf.quants, as for --direct. That only covers DIRECT_LEVELS, not the K types.
+    """
+    name = "python"
+    direct = True
+
+    def supports(self, level):
+        return level in DIRECT_LEVELS
+
+    def describe(self):
+        return f"{self.name} (gguf.quants, {', '.join(DIRECT_LEVELS)} only)"
+
+BACKENDS = ["auto", "llama-quantize", "python"]
+
+PATCHED_LLAMA_QUANTIZE_HINT = "the llama-quantize built from llama.cpp with ComfyUI-GGUF's tools/lcpp.patch"
+
+def find_llama_quantize(path=None):
+    """
+    llama-quantize from `path`, $LLAMA_QUANTIZE or next to this file, or None.
+    PATH isn't searched, a llama-quantize found there is most likely a stock
+    build that fails every level after the whole conversion has been written.
+    """
+    for candidate in [path, os.environ.get("LLAMA_QUANTIZE"), resource_path(LLAMA_QUANTIZE_NAME)]:
+        if candidate and os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+def get_backend(name="auto", llama_quantize=None):
+    """Raises ValueError if llama-quantize was asked for but can't be found"""
+    if name == "python":
+        return PythonBackend()
+    binary = find_llama_quantize(llama_quantize)
+    if binary:
+        return LlamaQuantizeBackend(binary)
+    if name == "llama-quantize":
+        raise ValueError(f"{LLAMA_QUANTIZE_NAME} not found, pass --llama-quantize or set LLAMA_QUANTIZE to {PATCHED_LLAMA_QUANTIZE_HINT}")
+    return PythonBackend()
+
+def unsupported_levels(job, backend):
+    return [level for level in job.outputs if not backend.supports(level)]
+
+# jobs with the same source would convert it into the same cache entry or temporary file
+source_locks = {}
+source_locks_guard = threading.Lock()
+
+def source_lock(src):
+    with source_locks_guard:
+        return source_locks.setdefault(os.path.normcase(os.path.abspath(src)), threading.Lock())
+
+def prepare_conversion(src, work_dir, log, cache=None, cancel=None, policy=None):
+    """
+    Returns the path of an F16/BF16 GGUF for src, converting it unless the cache
+    already has one, and whether the caller has to delete it afterwards. A cached
+    path has to be given back with cache.release() once it has been read.
+    Conversions with a precision policy are never cached.
+    """
+    if cache and not policy:
+        cached = cache.lookup(src)
+        if cached:
+            log(f"Using cached conversion: {cached}\n")
+            return cached, False
+        partial = cache.start_conversion(src)
+        try:
+            convert_model(src, partial, log, cancel=cancel)
+            cached = cache.store(src, partial)
+        finally:
+            cache.release(partial)
+        log(f"Cached conversion: {cached}\n")
+        return cached, False
+
+    # one temporary file per source, so jobs writing to the same directory don't collide
+    source_id = hashlib.sha1(os.path.abspath(src).encode()).hexdigest()[:8]
+    temp_gguf_file = os.path.join(work_dir, f"{TEMP_FILE_NAME}_{source_id}")
+    # left in place if this fails or is cancelled, so the next run can resume it
+    convert_model(src, temp_gguf_file, log, cancel=cancel, policy=policy)
+    return temp_gguf_file, True
+
+class Job:
+    """One source model and the quantize levels (with their output paths) to produce from it"""
+    def __init__(self, src, outputs, direct=False, policy=None, error_report=False):
+        self.src = src
+        self.outputs = outputs # level -> output path
+        self.direct = direct   # use convert.py --qtype for the levels that support it
+        self.policy = policy   # precision policy file passed to convert.py --policy
+        self.error_report = error_report # write <output>.errors.json for the direct levels
+
+    @classmethod
+    def from_levels(cls, src, levels, out_dir=None, direct=False, policy=None, error_report=False):
+        out_dir = out_dir or os.path.dirname(os.path.abspath(src))
+        outputs = {level: output_path(src, out_dir, level) for level in dict.fromkeys(levels)}
+        return cls(src, outputs, direct, policy, error_report)
+
+class OutputResult:
+    def __init__(self, src, level, path):
+        self.src = src
+        self.level = level
+        self.path = path
+        self.seconds = 0.0
+        self.error = None
+        self.skipped = False # already produced by an earlier, interrupted run
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return "failed"
+        return "skipped" if self.skipped else "ok"
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if self.error is None and os.path.isfile(self.path) else 0
+
+    def to_dict(self):
+        return {
+            "src": self.src,
+            "level": self.level,
+            "path": self.path,
+            "status": self.status,
+            "size": self.size,
+            "seconds": round(self.seconds, 3),
+            "error": None if self.error is None else str(self.error),
+        }
+
+class JobState:
+    """
+    Outputs that were completed, persisted to a JSON file after each one so a
+    crashed or interrupted run can be resumed without redoing them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.done = json.load(f)
+
+    @staticmethod
+    def key(src, path):
+        return f"{os.path.abspath(src)} -> {os.path.abspath(path)}"
+
+    def is_done(self, src, path):
+        entry = self.done.get(self.key(src, path))
+        # an output that was deleted or changed since has to be redone
+        return entry is not None and os.path.isfile(path) and os.path.getsize(path) == entry["size"]
+
+    def mark_done(self, src, path):
+        with self.lock:
+            self.done[self.key(src, path)] = {"size": os.path.getsize(path), "time": time.time()}
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.done, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+
+def default_parallel(count):
+    return min(count, max(1, (os.cpu_count() or 1) // 4))
+
+class Preflight:
+    """What a job is predicted to need, worked out from the source's tensor names, dtypes and shapes only"""
+    def __init__(self, job, arch, n_tensors, n_params):
+        self.job = job
+        self.arch = arch
+        self.n_tensors = n_tensors
+        self.n_params = n_params
+        self.intermediate = 0   # bytes of the F16/BF16 conversion, 0 if none has to be written
+        self.intermediate_dir = None
+        self.outputs = {}       # level -> predicted bytes, for the levels still to be produced
+        self.peak_memory = 0    # bytes of RAM at the most demanding step
+
+    def disk_usage(self):
+        """Bytes needed per directory while the job runs"""
+        needed = {}
+        for level, size in self.outputs.items():
+            directory = os.path.dirname(os.path.abspath(self.job.outputs[level]))
+            needed[directory] = needed.get(directory, 0) + size
+        if self.intermediate:
+            needed[self.intermediate_dir] = needed.get(self.intermediate_dir, 0) + self.intermediate
+        return needed
+
+    def describe(self):
+        lines = [f"{os.path.basename(self.job.src)}: {self.arch}, {self.n_tensors} tensors, {self.n_params / 1e9:.2f}B parameters"]
+        if self.intermediate:
+            lines.append(f"  F16/BF16 conversion: {self.intermediate / 1024**3:.2f} GB in {self.intermediate_dir}")
+        for level, size in self.outputs.items():
+            lines.append(f"  {level}: {size / 1024**3:.2f} GB")
+        lines.append(f"  Peak RAM: {self.peak_memory / 1024**3:.2f} GB")
+        return "\n".join(lines) + "\n"
+
+def preflight(job, parallel=None, cache=None, state=None, backend=None):
+    """
+    Predicts the intermediate and output sizes and the peak RAM of a job with the
+    same planning convert.py uses, without loading any tensor data.
+    Raises ValueError if the source or the policy can't be read, or the backend
+    can't produce one of the levels.
+    """
+    backend = backend or get_backend()
+    unsupported = unsupported_levels(job, backend)
+    if unsupported:
+        raise ValueError(f"{LLAMA_QUANTIZE_NAME} is needed for {', '.join(unsupported)}, set LLAMA_QUANTIZE to {PATCHED_LLAMA_QUANTIZE_HINT}")
+
+    import convert # gguf and the planning, torch isn't imported until tensors are loaded
+
+    try:
+        try:
+            # names, dtypes and shapes straight from the header
+            state_dict = ModelIndex.from_file(job.src)
+        except ValueError:
+            state_dict = convert.load_state_dict(job.src) # legacy (non-zip) checkpoints have to be loaded
+        model_arch = convert.detect_arch(state_dict)
+    except Exception as e:
+        raise ValueError(f"Can't read {job.src}: {e}") from e
+    policy = None
+    if job.policy:
+        policy = convert.load_policy(job.policy, model_arch.arch, model_arch.policy, convert.POLICY_QTYPES)
+    plans = convert.plan_model(state_dict, model_arch, policy=policy)
+    result = Preflight(job, model_arch.arch, len(plans), sum(plan.n_params for plan in plans))
+
+    todo = [level for level, path in job.outputs.items() if not (state and state.is_done(job.src, path))]
+    quantized = [level for level in todo if not ((job.direct or backend.direct) and level in DIRECT_LEVELS)]
+    for level in todo:
+        level_plans = convert.plan_model(state_dict, model_arch, LEVEL_QTYPES[level], policy)
+        result.outputs[level] = convert.estimate_file_size(level_plans, model_arch.arch)
+        if level not in quantized:
+            result.peak_memory = max(result.peak_memory, convert.estimate_peak_memory(level_plans))
+
+    if quantized:
+        result.peak_memory = max(result.peak_memory, convert.estimate_peak_memory(plans))
+        # every concurrent llama-quantize run works on one tensor at a time
+        largest = max((plan.n_params for plan in plans), default=0)
+        runs = parallel or default_parallel(len(quantized))
+        result.peak_memory = max(result.peak_memory, runs * largest * LLAMA_QUANTIZE_BYTES_PER_PARAM)
+        cache = None if job.policy else cache
+        if not (cache and os.path.isfile(cache.entry_path(job.src))):
+            result.intermediate = convert.estimate_file_size(plans, model_arch.arch)
+            result.intermediate_dir = cache.cache_dir if cache else os.path.dirname(os.path.abspath(job.outputs[quantized[0]]))
+    if todo:
+        result.peak_memory += PROCESS_OVERHEAD
+    return result
+
+def existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+def check_disk_space(preflights):
+    """
+    Returns (directory, needed, free) for every drive that can't hold what the
+    given jobs are predicted to write, with DISK_MARGIN of headroom.
+    """
+    drives = {}
+    for result in preflights:
+        for directory, size in result.disk_usage().items():
+            device = os.stat(existing_parent(directory)).st_dev
+            first_dir, total = drives.get(device, (directory, 0))
+            drives[device] = (first_dir, total + size)
+
+    short = []
+    for directory, size in drives.values():
+        needed = int(size * DISK_MARGIN)
+        free = shutil.disk_usage(existing_parent(directory)).free
+        if free < needed:
+            short.append((directory, needed, free))
+    return short
+
+def available_memory():
+    """Physical memory currently available in bytes, or None where it can't be determined"""
+    if os.name == "nt":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)] + [
+                (name, ctypes.c_ulonglong) for name in ("ullTotalPhys", "ullAvailPhys", "ullTotalPageFile",
+                    "ullAvailPageFile", "ullTotalVirtual", "ullAvailVirtual", "ullAvailExtendedVirtual")
+            ]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def run_job(job, log, parallel=None, cache=None, state=None, cancel=None, backend=None):
+    """
+    Produces every output of a job: direct levels through convert.py --qtype, the
+    rest by converting the source once and running the backend's llama-quantize
+    for each level. Both run concurrently, at most `parallel` at a time. Returns
+    one OutputResult per level.
+    Raises Cancelled once the running processes have been stopped if `cancel` is set.
+    """
+    backend = backend or get_backend()
+    results = [OutputResult(job.src, level, path) for level, path in job.outputs.items()]
+    todo = []
+    for result in results:
+        if state and state.is_done(job.src, result.path):
+            result.skipped = True
+            log(f"[{result.level}] Already completed, skipping: {result.path}\n")
+        elif not backend.supports(result.level):
+            result.error = ValueError(f"needs {LLAMA_QUANTIZE_NAME}")
+            log(f"[{result.level}] Skipped, this level needs {LLAMA_QUANTIZE_NAME}\n")
+        else:
+            todo.append(result)
+
+    for out_dir in {os.path.dirname(os.path.abspath(result.path)) for result in todo}:
+        os.makedirs(out_dir, exist_ok=True)
+
+    direct = [result for result in todo if (job.direct or backend.direct) and result.level in DIRECT_LEVELS]
+    quantized = [result for result in todo if result not in direct]
+    if not todo:
+        return results
+
+    parallel = parallel or default_parallel(len(todo))
+    # split the cores between the concurrent llama-quantize runs
+    threads = max(1, (os.cpu_count() or 1) // parallel)
+
+    from verify_gguf import expected_from_gguf, verify_gguf # pulls in gguf, keep the GUI start light
+
+    def convert_level(result):
+        log(f"[{result.level}] Starting conversion process...\n")
+        start = time.perf_counter()
+        try:
+            # written under another name until complete, an interrupted one is resumed by the next run
+            partial = result.path + ".partial"
+            error_report = result.path + ".errors.json" if job.error_report else None
+            convert_model(job.src, partial, log, qtype=result.level, prefix=f"[{result.level}] ", cancel=cancel,
+                          policy=job.policy, error_report=error_report)
+            os.replace(partial, result.path)
+            log(f"[{result.level}] Conversion completed successfully.\n")
+            if state:
+                state.mark_done(job.src, result.path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            result.error = e
+            log(f"[{result.level}] Error converting file: {e}\n")
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def quantize_level(result, gguf_file, convert_seconds):
+        log(f"[{result.level}] Starting quantization process...\n")
+        start = time.perf_counter()
+        try:
+            backend.quantize(gguf_file, result.path, result.level, log, threads=threads, cancel=cancel)
+            # llama-quantize only changes the tensor types, everything else has to match the file it read
+            problems = verify_gguf(result.path, expected_from_gguf(gguf_file))
+            if problems:
+                raise OSError(f"output verification failed: {'; '.join(problems[:3])}")
+            log(f"[{result.level}] Quantization completed successfully.\n")
+            if state:
+                state.mark_done(job.src, result.path)
+        except Cancelled:
+            # don't leave a truncated output behind
+            if os.path.exists(result.path):
+                os.remove(result.path)
+            raise
+        except (OSError, subprocess.CalledProcessError) as e:
+            result.error = e
+            log(f"[{result.level}] Error running llama-quantize: {e}\n")
+        # the shared conversion is counted towards every level that needed it
+        result.seconds = convert_seconds + time.perf_counter() - start
+        return result
+
+    # direct conversions and llama-quantize runs share one pool, the conversion
+    # llama-quantize reads runs here meanwhile
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = [pool.submit(convert_level, result) for result in direct]
+        if quantized:
+            # held until the conversion has been read and removed, another job of this source waits for it
+            with source_lock(job.src):
+                log("Starting conversion process...\n")
+                start = time.perf_counter()
+                try:
+                    gguf_file, is_temp = prepare_conversion(job.src, os.path.dirname(os.path.abspath(quantized[0].path)), log, cache, cancel, job.policy)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    log(f"Error converting file: {e}\n")
+                    for result in quantized:
+                        result.error = e
+                else:
+                    log("Conversion completed successfully.\n")
+                    convert_seconds = time.perf_counter() - start
+                    try:
+                        quantize_futures = [pool.submit(quantize_level, result, gguf_file, convert_seconds) for result in quantized]
+                        wait(quantize_futures) # all of them have to be done with the file before it goes
+                        for future in quantize_futures:
+                            future.result()
+                    finally:
+                        if is_temp and os.path.exists(gguf_file):
+                            os.remove(gguf_file)
+                        elif not is_temp:
+                            cache.release(gguf_file)
+        for future in futures:
+            future.result()
+    return results
+
+def run_batch(src, out_dir, levels, log, parallel=None, cache=None, cancel=None, backend=None):
+    return run_job(Job.from_levels(src, levels, out_dir), log, parallel=parallel, cache=cache, cancel=cancel, backend=backend)
+
+def run_jobs(jobs, log, max_jobs=1, parallel=None, cache=None, state=None, cancel=None, backend=None):
+    """Runs up to `max_jobs` jobs at once and returns all of their results in job order"""
+    with ThreadPoolExecutor(max_workers=max_jobs) as pool:
+        job_results = pool.map(lambda job: run_job(job, log, parallel=parallel, cache=cache, state=state, cancel=cancel, backend=backend), jobs)
+        return [result for results in job_results for result in results]
+
+def load_manifest(path):
+    """
+    Reads a YAML/JSON manifest: a list of jobs (or {"jobs": [...]}), each with
+    `src`, `levels` and optionally `out_dir`, `direct`, `policy` and
+    `error_report`. Relative paths are resolved against the manifest's directory.
+    Raises ValueError if it is invalid.
+    """
+    import yaml # only manifests need it, keeps the GUI's import of this module light
+
+    with open(path) as f:
+        try:
+            data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise ValueError(f"{path}: {e}") from e
+    entries = data.get("jobs") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path}: expected a non-empty list of jobs")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or "src" not in entry or "levels" not in entry:
+            raise ValueError(f"{path}: job {i} needs at least 'src' and 'levels'")
+        levels = entry["levels"] if isinstance(entry["levels"], list) else [entry["levels"]]
+        bad_levels = [level for level in levels if level not in QUANTIZE_LEVELS]
+        if bad_levels:
+            raise ValueError(f"{path}: job {i} has unknown levels {bad_levels}, expected any of {QUANTIZE_LEVELS}")
+        src = os.path.join(base_dir, entry["src"])
+        if not os.path.isfile(src):
+            raise ValueError(f"{path}: job {i} source not found: {src}")
+        out_dir = os.path.join(base_dir, entry["out_dir"]) if entry.get("out_dir") else None
+        policy = os.path.join(base_dir, entry["policy"]) if entry.get("policy") else None
+        if policy and not os.path.isfile(policy):
+            raise ValueError(f"{path}: job {i} policy not found: {policy}")
+        jobs.append(Job.from_levels(src, levels, out_dir, direct=bool(entry.get("direct", False)), policy=policy,
+                                    error_report=bool(entry.get("error_report", False))))
+    return jobs
+
+def format_summary(results):
+    lines = [f"{'Level':<8} {'Size (GB)':>10} {'Time (s)':>9}  Status   Output"]
+    for result in results:
+        status = result.status if result.error is None else f"failed ({result.error})"
+        lines.append(f"{result.level:<8} {result.size / 1024**3:>10.2f} {result.seconds:>9.1f}  {status:<7}  {result.path}")
+    return "\n".join(lines) + "\n"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert and quantize models without the GUI")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--src", help="Source model file.")
+    source.add_argument("--manifest", help="YAML/JSON list of jobs with src, levels and optionally out_dir, direct and policy.")
+    parser.add_argument("--levels", nargs="+", choices=QUANTIZE_LEVELS, help="Quantization levels to produce from --src.")
+    parser.add_argument("--out-dir", help="Output directory for --src, defaults to the directory of the source.")
+    parser.add_argument("--direct", action="store_true", help="Quantize supported levels directly with convert.py.")
+    parser.add_argument("--policy", help="Precision policy file for --src, see convert.py --policy.")
+    parser.add_argument("--error-report", action="store_true", help="Write the quantization error of every --direct level next to it as <output>.errors.json.")
+    parser.add_argument("--max-jobs", type=int, default=1, help="Number of models processed at once.")
+    parser.add_argument("--parallel", type=int, help="Number of direct conversions and llama-quantize runs at once per model.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use the conversion cache.")
+    parser.add_argument("--state", help="File recording completed outputs, defaults to <manifest>.state.json.")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore outputs completed by a previous run.")
+    parser.add_argument("--report", help="Write the results as JSON to this file.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the predicted sizes and peak RAM.")
+    parser.add_argument("--skip-preflight", action="store_true", help="Start even if the outputs are predicted not to fit.")
+    parser.add_argument("--backend", choices=BACKENDS, default="auto", help="How levels are quantized, auto uses llama-quantize if it can be found and python otherwise.")
+    parser.add_argument("--llama-quantize", help=f"Path of the {LLAMA_QUANTIZE_NAME} binary, defaults to $LLAMA_QUANTIZE or the bundled one. Needs ComfyUI-GGUF's lcpp.patch.")
+    args = parser.parse_args()
+
+    if args.src:
+        if not os.path.isfile(args.src):
+            parser.error("No input provided!")
+        if not args.levels:
+            parser.error("--levels is required with --src!")
+    if args.max_jobs < 1:
+        parser.error("--max-jobs must be at least 1!")
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel must be at least 1!")
+
+    return args
+
+def main():
+    args = parse_args()
+    log = lambda line: print(line, end="", flush=True)
+
+    if args.manifest:
+        try:
+            jobs = load_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            print(f"Invalid manifest: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    else:
+        jobs = [Job.from_levels(args.src, args.levels, args.out_dir, direct=args.direct, policy=args.policy, error_report=args.error_report)]
+
+    state = None
+    state_path = args.state or (f"{args.manifest}.state.json" if args.manifest else None)
+    if state_path:
+        if args.no_resume and os.path.exists(state_path):
+            os.remove(state_path)
+        state = JobState(state_path)
+
+    cache = None if args.no_cache else ConversionCache()
+
+    try:
+        backend = get_backend(args.backend, args.llama_quantize)
+        log(f"Quantizing with {backend.describe()}\n")
+        preflights = [preflight(job, parallel=args.parallel, cache=cache, state=state, backend=backend) for job in jobs]
+    except ValueError as e:
+        print(f"Preflight failed: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    for result in preflights:
+        log(result.describe())
+    # jobs running at the same time need their RAM at the same time
+    peak_memory = sum(sorted((result.peak_memory for result in preflights), reverse=True)[:args.max_jobs])
+    memory = available_memory()
+    if memory is not None and peak_memory > memory:
+        log(f"Warning: up to {peak_memory / 1024**3:.2f} GB of RAM may be needed, {memory / 1024**3:.2f} GB available.\n")
+    short = check_disk_space(preflights)
+    for directory, needed, free in short:
+        log(f"Not enough space for {directory}: {needed / 1024**3:.2f} GB needed, {free / 1024**3:.2f} GB free.\n")
+    if args.dry_run:
+        return EXIT_NO_SPACE if short else EXIT_OK
+    if short and not args.skip_preflight:
+        return EXIT_NO_SPACE
+    log("\n")
+
+    try:
+        results = run_jobs(jobs, log, max_jobs=args.max_jobs, parallel=args.parallel, cache=cache, state=state, backend=backend)
+    except KeyboardInterrupt:
+        log("Interrupted, rerun the same command to resume.\n")
+        return EXIT_INTERRUPTED
+
+    log("\n" + format_summary(results))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([result.to_dict() for result in results], f, indent=2)
+    return EXIT_OK if all(result.error is None for result in results) else EXIT_FAILED
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Quantization error metrics: how far the dequantized output of convert.py is
+from the source weights. Errors are accumulated chunk by chunk as the tensors
+are converted, so measuring them never holds more than one extra chunk.
+"""
+import json
+import math
+import threading
+
+import numpy as np
+
+class TensorError:
+    """Running sums for the error of one tensor, fed one chunk at a time"""
+    def __init__(self):
+        self.count = 0
+        self.sq_error = 0.0  # sum of squared errors
+        self.sq_signal = 0.0 # sum of squared source values
+        self.max_abs = 0.0
+        self.lock = threading.Lock() # pieces of one tensor can be converted at the same time
+
+    def add(self, ref, approx):
+        """Adds the difference between a chunk of source values and its dequantized counterpart"""
+        diff = np.subtract(approx, ref, dtype=np.float32)
+        if not diff.size:
+            return
+        # BLAS dot products, several times faster than float64 sums and precise enough per chunk
+        diff = diff.ravel()
+        ref = ref.ravel().astype(np.float32, copy=False)
+        sq_error = float(np.dot(diff, diff))
+        sq_signal = float(np.dot(ref, ref))
+        max_abs = float(max(diff.max(), -diff.min())) # without an abs() copy of the chunk
+        with self.lock:
+            self.count += diff.size
+            self.sq_error += sq_error
+            self.sq_signal += sq_signal
+            self.max_abs = max(self.max_abs, max_abs)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sq_error += other.sq_error
+        self.sq_signal += other.sq_signal
+        self.max_abs = max(self.max_abs, other.max_abs)
+
+    def to_dict(self):
+        # snr is None for lossless tensors, json has no infinity
+        return {
+            "count": self.count,
+            "rmse": math.sqrt(self.sq_error / self.count) if self.count else 0.0,
+            "max_abs": self.max_abs,
+            "snr_db": 10 * math.log10(self.sq_signal / self.sq_error) if self.sq_error and self.sq_signal else None,
+        }
+
+def block_name(key):
+    """The block a tensor belongs to, e.g. double_blocks.3 (or img_in for tensors outside of any block)"""
+    parts = key.split(".")
+    for i, part in enumerate(parts):
+        if part.isdigit():
+            return ".".join(parts[:i + 1])
+    return parts[0]
+
+def layer_name(key):
+    """The same layer across all blocks, e.g. double_blocks.*.img_attn.qkv.weight"""
+    return ".".join("*" if part.isdigit() else part for part in key.split("."))
+
+class ErrorReport:
+    """
+    Errors of every measured tensor in write order, aggregated per block and
+    per layer. Written as JSON, summarized as text for the log.
+    """
+    def __init__(self):
+        self.tensors = []
+
+    def add(self, plan, error):
+        self.tensors.append((plan, error))
+
+    def aggregate(self, group):
+        groups = {}
+        for plan, error in self.tensors:
+            groups.setdefault(group(plan.key), TensorError()).merge(error)
+        return {name: error.to_dict() for name, error in groups.items()}
+
+    def total(self):
+        total = TensorError()
+        for _, error in self.tensors:
+            total.merge(error)
+        return total.to_dict()
+
+    def to_dict(self):
+        return {
+            "tensors": [
+                {"key": plan.key, "old_dtype": str(plan.old_dtype), "qtype": plan.qtype.name, **error.to_dict()}
+                for plan, error in self.tensors
+            ],
+            "blocks": self.aggregate(block_name),
+            "layers": self.aggregate(layer_name),
+            "total": self.total(),
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def format_summary(self, worst=5):
+        total = self.total()
+        snr = "lossless" if total["snr_db"] is None else f"SNR {total['snr_db']:.1f} dB"
+        lines = [
+            f"* Quantization error over {len(self.tensors)} tensors: RMSE {total['rmse']:.3g}, "
+            f"max {total['max_abs']:.3g}, {snr}"
+        ]
+        lossy = [(plan, error.to_dict()) for plan, error in self.tensors if error.sq_error]
+        lossy.sort(key=lambda item: item[1]["snr_db"])
+        for plan, metrics in lossy[:worst]:
+            lines.append(f"  {metrics['snr_db']:>6.1f} dB  {plan.qtype.name:<5} {plan.key}")
+        return "\n".join(lines)
@@ -0,0 +1,148 @@
+"""
+Precision policies: which tensors convert.py keeps in F32, quantizes or leaves
+alone, per architecture. Only uses the standard library (pyyaml for files) so
+the templates in model_index.py can carry a policy without importing torch.
+"""
+import re
+
+QUANTIZATION_THRESHOLD = 1024
+REARRANGE_THRESHOLD = 512
+
+# weights to keep as max precision
+KEEP_F32 = [
+    "time_embedding.",
+    "add_embedding.",
+    "time_in.",
+    "txt_in.",
+    "vector_in.",
+    "img_in.",
+    "guidance_in.",
+    "final_layer.",
+]
+
+FLOAT_QTYPES = ["F32", "F16", "BF16"]
+
+class PolicyRule:
+    """Forces tensors whose name matches `match` (a regex) and the optional size/dtype limits to `qtype`"""
+    def __init__(self, match, qtype, min_params=None, max_params=None, dtypes=None):
+        self.match = match
+        self.pattern = re.compile(match)
+        self.qtype = qtype
+        self.min_params = min_params
+        self.max_params = max_params
+        self.dtypes = set(dtypes) if dtypes else None # safetensors dtype names, e.g. BF16
+
+    def matches(self, key, n_params, dtype):
+        return (
+            self.pattern.search(key) is not None
+            and (self.min_params is None or n_params >= self.min_params)
+            and (self.max_params is None or n_params <= self.max_params)
+            and (self.dtypes is None or dtype in self.dtypes)
+        )
+
+class QuantPolicy:
+    """
+    Weights whose name contains any of `keep_f32` stay in F32 (for F32/BF16
+    sources) and are never quantized, nor are tensors up to
+    `quantization_threshold` elements. `rearrange_threshold` is the minimum size
+    for the shape_fix reshape. `rules` are checked in order after that and the
+    first match decides the qtype: float types always apply, quantized types
+    only when quantizing directly (convert.py --qtype).
+    """
+    def __init__(self, keep_f32=KEEP_F32, quantization_threshold=QUANTIZATION_THRESHOLD,
+                 rearrange_threshold=REARRANGE_THRESHOLD, rules=()):
+        self.keep_f32 = list(keep_f32)
+        self.quantization_threshold = quantization_threshold
+        self.rearrange_threshold = rearrange_threshold
+        self.rules = list(rules)
+        # one compiled alternation instead of a substring scan per entry
+        self.keep_f32_pattern = re.compile("|".join(re.escape(x) for x in self.keep_f32)) if self.keep_f32 else None
+
+    def keeps_f32(self, key):
+        return self.keep_f32_pattern is not None and ".weight" in key and self.keep_f32_pattern.search(key) is not None
+
+    def override(self, key, n_params, dtype, quantizing):
+        """qtype name forced by the first matching rule, or None"""
+        for rule in self.rules:
+            if rule.matches(key, n_params, dtype):
+                if rule.qtype in FLOAT_QTYPES or quantizing:
+                    return rule.qtype
+                return None
+        return None
+
+    def updated(self, data, valid_qtypes=None):
+        """
+        New policy with the settings in `data` (parsed YAML/JSON) applied on top of
+        this one. `rules` are checked before the existing ones. Raises ValueError.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("policy must be a mapping")
+        unknown = set(data) - {"keep_f32", "quantization_threshold", "rearrange_threshold", "rules"}
+        if unknown:
+            raise ValueError(f"unknown policy settings: {sorted(unknown)}")
+
+        keep_f32 = data.get("keep_f32", self.keep_f32)
+        if not is_string_list(keep_f32):
+            raise ValueError("keep_f32 must be a list of strings")
+        thresholds = {}
+        for name in ("quantization_threshold", "rearrange_threshold"):
+            thresholds[name] = data.get(name, getattr(self, name))
+            if not is_int(thresholds[name]):
+                raise ValueError(f"{name} must be an integer")
+        if not isinstance(data.get("rules") or [], list):
+            raise ValueError("rules must be a list")
+
+        rules = []
+        for i, entry in enumerate(data.get("rules") or []):
+            if not isinstance(entry, dict) or "match" not in entry or "qtype" not in entry:
+                raise ValueError(f"rule {i} needs at least 'match' and 'qtype'")
+            if not isinstance(entry["match"], str):
+                raise ValueError(f"rule {i}: match must be a string")
+            if valid_qtypes is not None and entry["qtype"] not in valid_qtypes:
+                raise ValueError(f"rule {i} has unsupported qtype {entry['qtype']!r}, use one of {', '.join(valid_qtypes)}")
+            for name in ("min_params", "max_params"):
+                if entry.get(name) is not None and not is_int(entry[name]):
+                    raise ValueError(f"rule {i}: {name} must be an integer")
+            if entry.get("dtypes") is not None and not is_string_list(entry["dtypes"]):
+                raise ValueError(f"rule {i}: dtypes must be a list of strings")
+            try:
+                rules.append(PolicyRule(**entry))
+            except (TypeError, re.error) as e:
+                raise ValueError(f"rule {i}: {e}") from e
+
+        return QuantPolicy(keep_f32=keep_f32, rules=rules + self.rules, **thresholds)
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_string_list(value):
+    # a bare string would otherwise be split into single characters
+    return isinstance(value, (list, tuple)) and all(isinstance(x, str) for x in value)
+
+DEFAULT_POLICY = QuantPolicy()
+
+def load_policy(path, arch, base, valid_qtypes=None):
+    """
+    Reads a YAML/JSON policy file. Top-level settings apply to every
+    architecture, the ones under `archs: {<arch>: ...}` only to that one.
+    Raises ValueError if the file is invalid.
+    """
+    import yaml
+
+    try:
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError) as e:
+        raise ValueError(f"{path}: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: policy must be a mapping")
+
+    data = dict(data)
+    per_arch = data.pop("archs", None) or {}
+    try:
+        policy = base.updated(data, valid_qtypes)
+        if arch in per_arch:
+            policy = policy.updated(per_arch[arch], valid_qtypes)
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from e
+    return policy
@@ -0,0 +1,163 @@
+"""
+Checks a finished GGUF file against what should be in it: tensor count, names,
+shapes, qtypes and the comfy.gguf.orig_shape entries. The file is opened
+through GGUFReader's memory map, so only the header is read unless checksums
+are asked for, and those stream the tensor data in blocks.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import gguf
+
+ORIG_SHAPE_PREFIX = "comfy.gguf.orig_shape."
+VERIFY_BLOCK_SIZE = 64 * 1024**2 # bytes of tensor data hashed at a time
+
+class ExpectedTensor:
+    """What the output should contain for one tensor, qtype None if any type is fine"""
+    def __init__(self, name, shape, qtype=None, orig_shape=None):
+        self.name = name
+        self.shape = tuple(shape) # numpy order, like TensorPlan.shape
+        self.qtype = qtype
+        self.orig_shape = None if orig_shape is None else tuple(orig_shape)
+
+def expected_from_plans(plans, check_qtypes=True):
+    return [
+        ExpectedTensor(plan.key, plan.shape, plan.qtype if check_qtypes else None, plan.orig_shape)
+        for plan in plans
+    ]
+
+def field_value(field):
+    values = [field.parts[i] for i in field.data]
+    if field.types[-1] == gguf.GGUFValueType.STRING:
+        values = [bytes(value).decode("utf-8") for value in values]
+    else:
+        values = [value.tolist()[0] for value in values]
+    return values if field.types[0] == gguf.GGUFValueType.ARRAY else values[0]
+
+def read_orig_shapes(reader):
+    return {
+        name[len(ORIG_SHAPE_PREFIX):]: tuple(field_value(field))
+        for name, field in reader.fields.items() if name.startswith(ORIG_SHAPE_PREFIX)
+    }
+
+def expected_from_gguf(path):
+    """Names, shapes and orig_shape entries of another GGUF, e.g. the F16 file llama-quantize read"""
+    reader = gguf.GGUFReader(path)
+    orig_shapes = read_orig_shapes(reader)
+    return [
+        ExpectedTensor(tensor.name, reversed([int(dim) for dim in tensor.shape]), None, orig_shapes.get(tensor.name))
+        for tensor in reader.tensors
+    ]
+
+def name_list(names, limit=10):
+    more = f" and {len(names) - limit} more" if len(names) > limit else ""
+    return ", ".join(names[:limit]) + more
+
+def verify_gguf(path, expected, arch=None):
+    """Problems found in the GGUF at `path`, an empty list if it matches `expected`"""
+    try:
+        reader = gguf.GGUFReader(path)
+    except Exception as e:
+        # a truncated or garbled file fails while the reader maps its header and tensor info
+        return [f"can't read {path}: {e}"]
+
+    problems = []
+    if arch is not None:
+        field = reader.fields.get("general.architecture")
+        found = field_value(field) if field is not None else None
+        if found != arch:
+            problems.append(f"architecture is {found}, expected {arch}")
+
+    names = [tensor.name for tensor in reader.tensors]
+    if len(names) != len(expected):
+        problems.append(f"{len(names)} tensors, expected {len(expected)}")
+    missing = sorted({tensor.name for tensor in expected} - set(names))
+    extra = sorted(set(names) - {tensor.name for tensor in expected})
+    if missing:
+        problems.append(f"missing tensors: {name_list(missing)}")
+    if extra:
+        problems.append(f"unexpected tensors: {name_list(extra)}")
+
+    tensors = {tensor.name: tensor for tensor in reader.tensors}
+    for spec in expected:
+        tensor = tensors.get(spec.name)
+        if tensor is None:
+            continue
+        # the reader lists dimensions in ggml order, innermost first
+        shape = tuple(reversed([int(dim) for dim in tensor.shape]))
+        if shape != spec.shape:
+            problems.append(f"{spec.name}: shape {shape}, expected {spec.shape}")
+        if spec.qtype is not None and tensor.tensor_type != spec.qtype:
+            problems.append(f"{spec.name}: type {tensor.tensor_type.name}, expected {spec.qtype.name}")
+        if tensor.data_offset + tensor.n_bytes > len(reader.data):
+            problems.append(f"{spec.name}: data runs past the end of the file")
+
+    orig_shapes = read_orig_shapes(reader)
+    for spec in expected:
+        found = orig_shapes.get(spec.name)
+        if found != spec.orig_shape:
+            problems.append(f"{spec.name}: orig_shape {found}, expected {spec.orig_shape}")
+    return problems
+
+def tensor_checksums(path, block_size=VERIFY_BLOCK_SIZE):
+    """name -> sha256 of the tensor's bytes, hashed straight from the memory map a block at a time"""
+    reader = gguf.GGUFReader(path)
+    checksums = {}
+    for tensor in reader.tensors:
+        sha = hashlib.sha256()
+        for start in range(tensor.data_offset, tensor.data_offset + tensor.n_bytes, block_size):
+            stop = min(start + block_size, tensor.data_offset + tensor.n_bytes)
+            sha.update(reader.data[start:stop])
+        checksums[tensor.name] = sha.hexdigest()
+    return checksums
+
+def compare_checksums(checksums, expected):
+    return [
+        f"{name}: checksum differs" for name, digest in checksums.items()
+        if name in expected and expected[name] != digest
+    ]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check a GGUF file produced by convert.py or llama-quantize")
+    parser.add_argument("path", help="GGUF file to check.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--src", help="Source model the file was converted from, tensor types are not checked.")
+    source.add_argument("--reference", help="GGUF with the same tensors, e.g. the F16 file it was quantized from.")
+    parser.add_argument("--checksums", help="Write the sha256 of every tensor as JSON to this file.")
+    parser.add_argument("--expect-checksums", help="Compare the tensor data to checksums written by an earlier run.")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    arch = None
+    if args.src:
+        import convert # pulls in torch, only needed to plan the source
+        state_dict = convert.load_state_dict(args.src)
+        model_arch = convert.detect_arch(state_dict)
+        arch = model_arch.arch
+        expected = expected_from_plans(convert.plan_model(state_dict, model_arch), check_qtypes=False)
+    else:
+        expected = expected_from_gguf(args.reference)
+
+    problems = verify_gguf(args.path, expected, arch)
+    if not problems and (args.checksums or args.expect_checksums):
+        checksums = tensor_checksums(args.path)
+        if args.checksums:
+            with open(args.checksums, "w") as f:
+                json.dump(checksums, f, indent=2)
+        if args.expect_checksums:
+            with open(args.expect_checksums) as f:
+                problems = compare_checksums(checksums, json.load(f))
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        return 1
+    print(f"* {os.path.basename(args.path)}: {len(expected)} tensors OK")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())